@@ -0,0 +1,2 @@
+// 02.js
+// nothing to do
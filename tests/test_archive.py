@@ -0,0 +1,128 @@
+import unittest
+import pathlib, io, os, tempfile, zipfile, zlib
+from unittest import mock
+
+import tinypublisher.archive as a
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.curdir = pathlib.Path(__file__).parent / 'assets'
+        self.date_time = (2020, 1, 2, 3, 4, 6)
+        self.tasks = [a.Task('mimetype', self.curdir / 'spine.tsv', a.STORED, date_time=self.date_time)]
+        self.tasks += [a.Task(f'book/{p.name}', p, date_time=self.date_time)
+                       for p in sorted(self.curdir.iterdir()) if p.is_file()]
+
+    def test_write_zip(self):
+        outputs = []
+        for jobs in [1, 2]:
+            f = io.BytesIO()
+            a.write_zip(f, self.tasks, jobs)
+            outputs.append(f.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+
+        with zipfile.ZipFile(io.BytesIO(outputs[0])) as zf:
+            self.assertIsNone(zf.testzip())
+            infos = zf.infolist()
+            self.assertEqual([info.filename for info in infos], [task.name for task in self.tasks])
+            self.assertEqual(infos[0].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(infos[0].date_time, self.date_time)
+            self.assertEqual(zf.read('book/style.css'), (self.curdir / 'style.css').read_bytes())
+
+    def test_streamed(self):
+        streamed_size = a.STREAMED_SIZE
+        a.STREAMED_SIZE = 1024
+        try:
+            f = io.BytesIO()
+            a.write_zip(f, self.tasks, 2)
+        finally:
+            a.STREAMED_SIZE = streamed_size
+
+        with zipfile.ZipFile(f) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.read('book/01.png'), (self.curdir / '01.png').read_bytes())
+
+    def test_zip64(self):
+        f = io.BytesIO()
+        with a.ArchiveWriter(f) as writer:
+            for i in range(0x10000 + 1):
+                data = str(i).encode()
+                writer.add(a.Member(f'{i}.txt', zlib.crc32(data), len(data), a.STORED, data,
+                                    self.date_time))
+        with zipfile.ZipFile(f) as zf:
+            self.assertEqual(len(zf.infolist()), 0x10000 + 1)
+            self.assertEqual(zf.read('65536.txt'), b'65536')
+
+        with self.assertRaises(a.ArchiveError):
+            writer.add(a.Member('0.txt', 0, 0, a.STORED, b'', self.date_time))
+
+    def test_member_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = a.MemberCache(pathlib.Path(tmp))
+            outputs = []
+            for jobs in [1, 2, 1]:
+                f = io.BytesIO()
+                a.write_zip(f, self.tasks, jobs, cache=cache)
+                outputs.append(f.getvalue())
+            f = io.BytesIO()
+            a.write_zip(f, self.tasks)
+            self.assertEqual(outputs, [f.getvalue()] * 3)
+
+            # the entries are shared by the members of the same contents and level
+            entries = list(pathlib.Path(tmp).glob('*/*'))
+            self.assertEqual(len(entries), len(self.tasks) - 1)
+            data = (self.curdir / 'style.css').read_bytes()
+            member = cache.compress('other/style.css', data, self.date_time)
+            self.assertTrue(member.cached)
+            self.assertEqual(member.compress_type, a.DEFLATED)
+            self.assertEqual(zlib.decompress(member.data, -15), data)
+            self.assertFalse(cache.compress('style.css', data, self.date_time, 9).cached)
+            noise = os.urandom(1024)
+            self.assertEqual(cache.compress('noise', noise, self.date_time).compress_type, a.STORED)
+            member = cache.compress('noise', noise, self.date_time)
+            self.assertTrue(member.cached)
+            self.assertEqual((member.compress_type, member.data), (a.STORED, noise))
+
+    def test_member_cache_broken(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = a.MemberCache(pathlib.Path(tmp))
+            data = (self.curdir / 'style.css').read_bytes()
+            cache.compress('style.css', data, self.date_time)
+            (entry,) = pathlib.Path(tmp).glob('*/*')
+            for broken in [entry.read_bytes()[:-1] + b'!', entry.read_bytes()[:5], b'\x08']:
+                entry.write_bytes(broken)
+                with self.assertLogs('tinypublisher.archive', 'DEBUG'):
+                    member = cache.compress('style.css', data, self.date_time)
+                self.assertFalse(member.cached)
+                self.assertEqual(zlib.decompress(member.data, -15), data)
+                self.assertTrue(cache.compress('style.css', data, self.date_time).cached)
+
+            # a failed write leaves no temporary file, which prune never removes
+            with mock.patch.object(a.os, 'replace', side_effect=OSError('full')):
+                with self.assertLogs('tinypublisher.archive', 'WARNING'):
+                    cache.compress('other', b'other' * 100, self.date_time)
+            self.assertEqual(list(pathlib.Path(tmp).glob('*/*.tmp')), [])
+            writing = entry.parent / 'writing.tmp'
+            writing.write_bytes(b'...')
+            cache.max_bytes = 0
+            cache.prune()
+            self.assertEqual(list(pathlib.Path(tmp).glob('*/*')), [writing])
+
+    def test_member_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = a.MemberCache(pathlib.Path(tmp), max_bytes=0)
+            for i in range(3):
+                cache.compress(f'{i}.txt', str(i).encode() * 100, self.date_time)
+            entries = sorted(pathlib.Path(tmp).glob('*/*'))
+            for i, path in enumerate(entries):
+                os.utime(path, ns=(i * 10**9, i * 10**9))
+            # keeps the most recently used entries which fit
+            cache.max_bytes = sum(path.stat().st_size for path in entries[1:])
+            cache.prune()
+            self.assertEqual(sorted(pathlib.Path(tmp).glob('*/*')), entries[1:])
+            cache.max_bytes = 0
+            cache.prune()
+            self.assertEqual(list(pathlib.Path(tmp).glob('*/*')), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,13 @@
 import unittest
 import xml.etree.ElementTree as ET
-import pathlib, zipfile, logging
+import pathlib, zipfile, logging, asyncio, io, json, os, shutil, tempfile, time
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 
 import tinypublisher as app
 import tinypublisher.builder as b
 import tinypublisher.reader as r
+import tinypublisher.progress as progress
 
 
 class TestBuilder(unittest.TestCase):
@@ -111,5 +114,376 @@ class TestBuilder(unittest.TestCase):
         with zipfile.ZipFile(dest) as zf:
             self.assertIsNone(zf.testzip())
 
+    def test_size_report(self):
+        self.make_pkg()
+        self.builder.package_content_items(self.spec)
+        with self.assertRaises(b.BuilderError):
+            self.builder.size_report(self.spec)
+        self.builder.zipup()
+        report = self.builder.size_report(self.spec, largest=3)
+
+        dest = self.builder.destdir.parent / 'test.epub'
+        with zipfile.ZipFile(dest) as zf:
+            infos = {info.filename: info for info in zf.infolist()}
+        for item in report['items']:
+            info = infos['book/' + item['href']]
+            self.assertEqual((item['stored_bytes'], item['compressed_bytes']),
+                             (info.file_size, info.compress_size))
+        self.assertEqual(report['total']['compressed_bytes'],
+                         sum(info.compress_size for info in infos.values()))
+        self.assertEqual(report['by_media_type']['image/gif']['count'], 2)
+        self.assertEqual([row['name'] for row in report['largest']],
+                         ['book/items/01.png', 'book/items/cover.png', 'book/items/05.jpg'])
+        groups = {group['href']: group for group in report['by_spine_item']}
+        self.assertEqual(groups['items/02.xhtml']['count'], 5)
+        self.assertEqual([row['name'] for row in report['low_savings']], ['book/items/02.js'])
+
+    def test_minify(self):
+        self.spec.minify = True
+        builder = b.PackageBuilder('test-minify')
+        builder.build_with(self.spec)
+        book = builder.destdir / 'book'
+        self.assertEqual(set(builder.minified),
+                         {'book/navigation.xhtml', 'book/items/01.png.xhtml', 'book/items/02.xhtml',
+                          'book/items/03.svg', 'book/items/04.svg.xhtml', 'book/items/05.jpg.xhtml',
+                          'book/items/mark3.svg', 'book/items/style.css',
+                          'book/items/tinypublisherG1.css'})
+        for name, (original, minified) in builder.minified.items():
+            self.assertEqual((builder.destdir / name).stat().st_size, minified)
+            self.assertLess(minified, original)
+            if not name.endswith('.css'):
+                ET.parse(builder.destdir / name)
+
+        self.spec.minify = False
+        builder.build_with(self.spec)
+        self.assertEqual(builder.minified, {})
+        for name in ['02.xhtml', 'style.css']:
+            self.assertEqual((book / 'items' / name).read_bytes(),
+                             (self.spec.curdir / name).read_bytes())
+        self.assertEqual((book / 'items/tinypublisherG1.css').read_text(),
+                         (pathlib.Path(b.__file__).parent / 'templates/page.css').read_text())
+
+    def test_progress(self):
+        out = io.StringIO()
+        builder = b.PackageBuilder('test-progress', progress.EventStream(out, interval=3600))
+        builder.build_with(self.spec)
+        builder.zipup()
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(e['event'], e['stage']) for e in events],
+                         [('start', 'packaging'), ('finish', 'packaging'),
+                          ('start', 'zipping'), ('finish', 'zipping')])
+        self.assertEqual(events[1]['done'], len(builder.package_document_spec['pkg_items']))
+        self.assertEqual(events[3]['done'], len(builder.archived))
+        self.assertEqual(events[3]['bytes'], sum(info.file_size for info in builder.archived))
+
+    def test_build_async(self):
+        self.make_pkg()
+        dest = self.builder.destdir.parent / (self.builder.destdir.name + '.epub')
+        if dest.exists():
+            dest.unlink()
+        # the items are zipped while the last one is packaged
+        events = []
+        package_item = self.builder.package_content_item
+        def slow_package_item(spec, item):
+            if item is self.builder.package_document_spec['pkg_items'][-1]:
+                time.sleep(0.2)
+            size = package_item(spec, item)
+            events.append(('packaged', item.href))
+            return size
+        on_member = b._ZipWhilePackaging.on_member
+        def zipped(zipping, info):
+            events.append(('zipped', info.name))
+            on_member(zipping, info)
+        with mock.patch.object(self.builder, 'package_content_item', slow_package_item), \
+             mock.patch.object(b._ZipWhilePackaging, 'on_member', zipped):
+            asyncio.run(self.builder.build_async(self.spec, maxsize=2))
+        items = self.builder.package_document_spec['pkg_items']
+        self.assertLess(events.index(('zipped', 'book/' + items[0].href)),
+                        events.index(('packaged', items[-1].href)))
+
+        items_dir = self.builder.destdir / 'book/items'
+        self.assertEqual(len(list(items_dir.iterdir())),
+                         len(list(self.curdir.iterdir())) - 2 + 3 + 1 - 1)
+        with zipfile.ZipFile(dest) as zf:
+            self.assertIsNone(zf.testzip())
+            names = zf.namelist()
+        self.assertEqual(names[:4], ['mimetype', 'META-INF/container.xml', 'book/package.opf',
+                                     'book/navigation.xhtml'])
+        self.assertEqual(sorted(names), sorted(str(p.relative_to(self.builder.destdir))
+                                               for p in b._package_files(self.builder.destdir)))
+        self.assertEqual([info.name for info in self.builder.archived], names)
+
+        # a failed build leaves the package as it was
+        data = dest.read_bytes()
+        with mock.patch.object(self.builder, 'package_content_item', side_effect=OSError('full')):
+            with self.assertRaises(OSError):
+                asyncio.run(self.builder.build_async(self.spec))
+        self.assertEqual(dest.read_bytes(), data)
+        self.assertFalse(dest.with_name(dest.name + '.tmp').exists())
+
+    def test_reproducible(self):
+        self.make_pkg()
+        self.spec.uuid = None
+        self.spec.reproducible = True
+        dest = self.builder.destdir.parent / (self.builder.destdir.name + '.epub')
+
+        outputs = []
+        for _ in range(2):
+            self.builder.build_with(self.spec)
+            self.builder.zipup()
+            outputs.append(dest.read_bytes())
+        self.assertEqual(outputs[0], outputs[1])
+
+        with zipfile.ZipFile(dest) as zf:
+            first = zf.infolist()[0]
+            self.assertEqual((first.filename, first.compress_type),
+                             ('mimetype', zipfile.ZIP_STORED))
+
+        cached = self.builder.build_cached(self.spec)
+        self.assertEqual(cached.read_bytes(), outputs[0])
+        cache_files = list((self.builder.destdir.parent / '.cache').glob('test-*.epub'))
+        self.assertEqual(len(cache_files), 1)
+        self.assertEqual(cache_files[0].read_bytes(), outputs[0])
+
+    def test_build_cache(self):
+        self.make_pkg()
+        self.spec.uuid = None
+        self.spec.reproducible = True
+        cachedir = self.builder.destdir.parent / '.cache'
+        cachedir.mkdir(exist_ok=True)
+        other = cachedir / ('test-two-' + '0' * 64 + '.epub')
+        other.write_bytes(b'')
+
+        modified = []
+        with mock.patch.dict(os.environ):
+            for epoch in ['1600000000', '1700000000']:
+                os.environ['SOURCE_DATE_EPOCH'] = epoch
+                with zipfile.ZipFile(self.builder.build_cached(self.spec)) as zf:
+                    opf = ET.fromstring(zf.read('book/package.opf'))
+                modified.append(opf.find('.//{*}meta[@property="dcterms:modified"]').text)
+        self.assertEqual(modified, ['2020-09-13T12:26:40Z', '2023-11-14T22:13:20Z'])
+        self.assertTrue(other.exists())
+        other.unlink()
+
+    def test_images_per_page(self):
+        spec = self.parser.parse_text('01.png\tFirst\n05.jpg\n04.svg\t\t-\n'
+                                      'cover.png\tCover\nstar1.gif\nstar2.gif\n')
+        spec.language_tag = 'en'
+        spec.uuid = app.__appname__ + '.test'
+        builder = b.PackageBuilder('grouped')
+
+        spec.images_per_page = 2
+        builder.build_with(spec)
+        pkg_doc_tree = ET.parse(builder.destdir / 'book/package.opf')
+        self.assertEqual(len(pkg_doc_tree.findall('.//{*}spine/{*}itemref')), 4)
+
+        spec.images_per_page = 0
+        builder.build_with(spec)
+        pkg_doc_tree = ET.parse(builder.destdir / 'book/package.opf')
+        pages = [item.get('href') for item in pkg_doc_tree.findall('.//{*}manifest/{*}item')
+                 if item.get('href').endswith('.xhtml')]
+        self.assertEqual(pages, ['navigation.xhtml', 'items/01.png.xhtml', 'items/cover.png.xhtml'])
+
+        page_tree = ET.parse(builder.destdir / 'book/items/01.png.xhtml')
+        figures = page_tree.findall('.//{*}figure')
+        self.assertEqual(len(figures), 3)
+        self.assertEqual(figures[1].find('{*}img').get('src'), '05.jpg')
+        self.assertIsNotNone(figures[2].find('{http://www.w3.org/2000/svg}svg'))
+        self.assertEqual(figures[2].find('{*}figcaption').text, '04.svg')
+
+        nav_tree = ET.parse(builder.destdir / 'book/navigation.xhtml')
+        self.assertEqual([a.text for a in nav_tree.findall('.//{*}li/{*}a')], ['First', 'Cover'])
+
+    def test_manifest(self):
+        curdir = self.curdir.resolve()
+        manifest = b._make_pkg_doc_items(self.spec.spine, curdir)
+        self.assertEqual([item.id for item in manifest],
+                         [f'item{i}' for i in range(1, len(manifest) + 1)])
+        self.assertEqual(len(manifest.by_href), len(manifest))
+
+        added = manifest.add(b._ManifestItem(id='', href='items/01.png', media_type='image/png'))
+        self.assertIs(added, manifest.by_href['items/01.png'])
+        self.assertEqual(added.id, 'item1')
+        self.assertIs(manifest.find_file(self.curdir / '05.jpg', curdir),
+                      manifest.by_href['items/05.jpg'])
+        self.assertIsNone(manifest.find_file(self.curdir / 'cover.png', curdir))
+        # the items are not stated for a file which has no other names
+        self.assertIsNone(manifest._by_inode)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmpdir = pathlib.Path(tmp).resolve()
+            shutil.copyfile(self.curdir / 'cover.png', tmpdir / 'a.png')
+            os.link(tmpdir / 'a.png', tmpdir / 'b.png')
+            item = manifest.add(b._ManifestItem(id='', href='items/a.png', media_type='image/png',
+                                                src_path=tmpdir / 'a.png'))
+            self.assertIs(manifest.find_file(tmpdir / 'b.png', tmpdir), item)
+
+    def test_plan(self):
+        builder = b.PackageBuilder('test-plan')
+        plan = builder.plan(self.spec)
+        self.assertFalse((self.curdir / 'build/test-plan').exists())
+        self.assertEqual(plan['spine'], ['item2', 'item3', 'item4', 'item5', 'item7'])
+        self.assertEqual(len(plan['manifest']), 12)
+        self.assertEqual([page['href'] for page in plan['wrapping_pages']],
+                         ['items/01.png.xhtml', 'items/04.svg.xhtml', 'items/05.jpg.xhtml'])
+        self.assertEqual([point['title'] for point in plan['nav']],
+                         ['The first page', '03.svg: This is a co…', 'The last page'])
+        self.assertGreater(plan['estimated_bytes'],
+                           sum((self.curdir / name).stat().st_size for name in ['01.png', '05.jpg']))
+
+    def test_parallel_builds(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            curdir = pathlib.Path(tmp) / 'assets'
+            shutil.copytree(self.curdir, curdir, ignore=shutil.ignore_patterns('build'))
+
+            def build(name):
+                with open(curdir / 'spine.tsv') as f:
+                    spec = r.FileListParser(curdir).parse(f)
+                spec.book_title = 'parallel'
+                spec.reproducible = True
+                builder = b.PackageBuilder(name)
+                builder.build_with(spec)
+                builder.zipup()
+                with zipfile.ZipFile(builder.destdir.parent / f'{name}.epub') as zf:
+                    return {info.filename: zf.read(info) for info in zf.infolist()}
+
+            expected = build('sequential')
+            names = [f'parallel{i}' for i in range(8)]
+            with ThreadPoolExecutor(len(names)) as executor:
+                outputs = list(executor.map(build, names))
+        for output in outputs:
+            self.assertEqual(output, expected)
+
+    def test_render_to(self):
+        self.make_pkg()
+        self.builder.make_package_document(self.spec)
+        for name in ['package.opf', 'navigation.xhtml']:
+            f = io.StringIO()
+            b._render_to(f, name, **self.builder.package_document_spec)
+            self.assertEqual(f.getvalue(),
+                             b._template(name).render(**self.builder.package_document_spec))
+
+    def test_nested_navigation(self):
+        items = [b._ManifestItem(id='', href=f'items/{d}/{i:02}.jpg.xhtml', media_type='',
+                                 index_title=f'{d}-{i:02}', spine_item_p=True)
+                 for d in ['a', 'b'] for i in range(5)]
+        items.append(b._ManifestItem(id='', href='items/c.xhtml', media_type='',
+                                     index_title='c', spine_item_p=True))
+
+        points = b._nav_points(items, folders=True)
+        self.assertEqual([(p.title, p.href, len(p.children)) for p in points],
+                         [('a', 'items/a/00.jpg.xhtml', 5), ('b', 'items/b/00.jpg.xhtml', 5),
+                          ('c', 'items/c.xhtml', 0)])
+
+        points = b._nav_points(items, chunk=2)
+        self.assertEqual([p.title for p in points], ['a-00 – b-02', 'b-03 – c'])
+        self.assertEqual([p.title for p in points[0].children], ['a-00 – a-03', 'a-04 – b-02'])
+
+        titled = [b._ManifestItem(id='', href=f'items/{i}.xhtml', media_type='',
+                                  index_title=f'x – {i}', spine_item_p=True) for i in range(3)]
+        self.assertEqual([p.title for p in b._nav_points(titled, chunk=2)],
+                         ['x – 0 – x – 1', 'x – 2'])
+        with self.assertRaises(b.BuilderError):
+            b._nav_points(items, chunk=1)
+
+        self.make_pkg()
+        self.spec.nav_chunk = 2
+        self.spec.page_list = True
+        self.builder.make_package_document(self.spec)
+        self.builder.make_navigation_document(self.spec)
+        nav_tree = ET.parse(self.builder.destdir / 'book/navigation.xhtml')
+        toc = nav_tree.find('.//{*}nav[@id="toc"]')
+        self.assertEqual([a.text for a in toc.findall('{*}ol/{*}li/{*}a')],
+                         ['The first page – 03.svg: This is a co…', 'The last page'])
+        self.assertEqual([a.text for a in toc.findall('{*}ol/{*}li/{*}ol/{*}li/{*}a')],
+                         ['The first page', '03.svg: This is a co…'])
+        page_list = nav_tree.find('.//{*}nav[@id="page-list"]')
+        self.assertEqual([a.get('href') for a in page_list.findall('.//{*}a')],
+                         ['items/01.png.xhtml', 'items/02.xhtml', 'items/03.svg',
+                          'items/04.svg.xhtml', 'items/05.jpg.xhtml'])
+
+    def test_append_package(self):
+        lines = (self.curdir / 'spine.tsv').read_text().splitlines(keepends=True)
+        spec = self.parser.parse_text(''.join(lines[:3]))
+        spec.language_tag = 'en'
+        spec.uuid = app.__appname__ + '.test'
+        builder = b.PackageBuilder('appended')
+        builder.build_with(spec)
+        builder.zipup()
+        epub = builder.destdir.parent / 'appended.epub'
+        existing = [(item.id, item.href) for item in builder.package_document_spec['pkg_items']]
+        with zipfile.ZipFile(epub) as zf:
+            png = zf.getinfo('book/items/01.png')
+
+        b.append_package(epub, self.parser.parse_text(''.join(lines[3:])))
+
+        self.make_pkg()
+        self.spec.cover_image = None
+        self.builder.make_package_document(self.spec)
+        expected = [item.href for item in self.builder.package_document_spec['pkg_items']]
+        spine = [item.href for item in self.builder.package_document_spec['pkg_items']
+                 if item.spine_item_p]
+        with zipfile.ZipFile(epub) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.infolist()[0].filename, 'mimetype')
+            appended_png = zf.getinfo('book/items/01.png')
+            self.assertEqual((appended_png.CRC, appended_png.compress_size, appended_png.date_time),
+                             (png.CRC, png.compress_size, png.date_time))
+
+            pkg_doc_tree = ET.fromstring(zf.read('book/package.opf'))
+            items = [(item.get('id'), item.get('href'))
+                     for item in pkg_doc_tree.findall('.//{*}manifest/{*}item')][1:]
+            self.assertEqual(items[:len(existing)], existing)
+            self.assertEqual([id for id, _ in items],
+                             [f'item{i}' for i in range(1, len(items) + 1)])
+            self.assertEqual(sorted(href for _, href in items), sorted(expected))
+            self.assertEqual(pkg_doc_tree.find('.//{*}identifier').text, self.spec.id)
+            hrefs = dict(items)
+            self.assertEqual([hrefs[ref.get('idref')] for ref in pkg_doc_tree.findall('.//{*}itemref')],
+                             spine)
+
+            nav_tree = ET.fromstring(zf.read('book/navigation.xhtml'))
+            self.assertEqual([a.text for a in nav_tree.findall('.//{*}li/{*}a')],
+                             ['The first page', '03.svg: This is a co…', 'The last page'])
+            for href in expected:
+                zf.getinfo('book/' + href)
+
+        with self.assertRaises(b.BuilderError):
+            b.append_package(epub, self.parser.parse_text(lines[4]))
+        outside = r.FileListParser(self.curdir.parent / 'assets2').parse_text('')
+        outside.append_spine_item(content_document=str(self.curdir.resolve() / '01.png'),
+                                  media_type='image/png', index_title='', content_title='',
+                                  content_caption='')
+        with self.assertRaisesRegex(b.BuilderError, 'descendant of the current directory'):
+            b.append_package(epub, outside)
+
+    def test_append_package_twice(self):
+        lines = (self.curdir / 'spine.tsv').read_text().splitlines(keepends=True)
+        spec = self.parser.parse_text(lines[0])
+        spec.id = 'urn:a&amp;b'
+        spec.book_title = 'A &amp; B'
+        spec.language_tag = 'en'
+        builder = b.PackageBuilder('appended-twice')
+        builder.build_with(spec)
+        builder.zipup()
+        epub = builder.destdir.parent / 'appended-twice.epub'
+
+        # the metadata read back are escaped again in each append
+        b.append_package(epub, self.parser.parse_text(lines[1]))
+        b.append_package(epub, self.parser.parse_text(lines[2]))
+        with zipfile.ZipFile(epub) as zf:
+            pkg_doc_tree = ET.fromstring(zf.read('book/package.opf'))
+        self.assertEqual(pkg_doc_tree.find('.//{*}identifier').text, 'urn:a&b')
+        self.assertEqual(pkg_doc_tree.find('.//{*}title').text, 'A & B')
+        self.assertEqual(len(pkg_doc_tree.findall('.//{*}itemref')), 3)
+
+        # a failed append leaves the package as it was, without a temporary file
+        data = epub.read_bytes()
+        with mock.patch.object(b.archive, 'write_files', side_effect=OSError('full')):
+            with self.assertRaises(OSError):
+                b.append_package(epub, self.parser.parse_text(lines[3]))
+        self.assertEqual(epub.read_bytes(), data)
+        self.assertFalse(epub.with_name(epub.name + '.tmp').exists())
+
 if __name__ == '__main__':
     unittest.main()
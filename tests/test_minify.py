@@ -0,0 +1,94 @@
+import unittest
+import pathlib, tempfile
+
+import tinypublisher.minify as m
+
+
+def minified(minifier, text, size=None):
+    if size is None:
+        return minifier.feed(text) + minifier.close()
+    out = ''.join(minifier.feed(text[i:i + size]) for i in range(0, len(text), size))
+    return out + minifier.close()
+
+
+class TestMinify(unittest.TestCase):
+    def test_xml(self):
+        doc = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml">
+  <head>
+    <!-- a comment -->
+    <title>  A   title </title>
+  </head>
+  <body>
+    <p class="a   b"
+       id = "c"><b>bold</b> <i>italic</i>&#160;&amp;</p>
+    <pre>  keep
+    this  </pre>
+    <svg xmlns="http://www.w3.org/2000/svg">
+      <g>
+        <text xml:space="preserve">  a  b  </text>
+      </g>
+    </svg>
+    <br />
+  </body>
+</html>
+'''
+        expected = ('<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE html>'
+                    '<html xmlns="http://www.w3.org/1999/xhtml"><head><title> A title </title></head><body>\n'
+                    '<p class="a   b" id="c"><b>bold</b> <i>italic</i>&#160;&amp;</p>\n'
+                    '<pre>  keep\n    this  </pre>\n'
+                    '<svg xmlns="http://www.w3.org/2000/svg"><g><text xml:space="preserve">  a  b  </text></g></svg>\n'
+                    '<br/>\n'
+                    '</body></html>')
+        self.assertEqual(minified(m.XMLMinifier(), doc), expected)
+        for size in [1, 2, 7]:
+            self.assertEqual(minified(m.XMLMinifier(), doc, size), expected)
+
+    def test_css(self):
+        css = '''/*! license */
+body , p {
+  margin : 0 ;  /* comment */
+  font-family: "a  ;  b", 'c/*d*/';
+}
+a :hover { width: calc(1px + 2px) }
+'''
+        expected = ('/*! license */body,p{margin :0;font-family:"a  ;  b",\'c/*d*/\';}'
+                    'a :hover{width:calc(1px + 2px)}')
+        self.assertEqual(minified(m.CSSMinifier(), css), expected)
+        for size in [1, 3]:
+            self.assertEqual(minified(m.CSSMinifier(), css, size), expected)
+
+        # a string left open ends at the newline, which is kept, instead of
+        # holding the rest
+        minifier = m.CSSMinifier()
+        self.assertEqual(minifier.feed('a { content: "open\n}\nb { c: d }'), 'a{content:"open\n}b{c:d')
+        self.assertEqual(minifier.close(), '}')
+        cases = {'a { content: "open\n}\nb { c: d }': 'a{content:"open\n}b{c:d}',
+                 "a { content: 'open\\'\n  }\nb { c: d }": "a{content:'open\\'\n}b{c:d}"}
+        for css, expected in cases.items():
+            for size in [None, 1, 4]:
+                self.assertEqual(minified(m.CSSMinifier(), css, size), expected)
+
+    def test_minify_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            target = pathlib.Path(tmp) / 'style.css'
+            src = pathlib.Path(__file__).parent / 'assets/style.css'
+            original, size = m.minify_file(src, target, 'text/css')
+            self.assertEqual(original, src.stat().st_size)
+            self.assertEqual(size, target.stat().st_size)
+            self.assertLess(size, original)
+
+            # the declared encoding is kept, and an undecodable file is copied as is
+            src = pathlib.Path(tmp) / 'page.xhtml'
+            src.write_bytes('<?xml version="1.0" encoding="Shift_JIS"?>\n<p>  日本語  </p>\n'.encode('shift_jis'))
+            m.minify_file(src, target, 'application/xhtml+xml')
+            self.assertEqual(target.read_bytes(),
+                             '<?xml version="1.0" encoding="Shift_JIS"?><p> 日本語 </p>'.encode('shift_jis'))
+            src.write_bytes(b'<p>  \xff  </p>\n')
+            with self.assertLogs('tinypublisher.minify', 'WARNING'):
+                self.assertEqual(m.minify_file(src, target, 'application/xhtml+xml'), (13, 13))
+            self.assertEqual(target.read_bytes(), src.read_bytes())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import io, json
+
+import tinypublisher.progress as p
+
+
+class _Terminal(io.StringIO):
+    def isatty(self):
+        return True
+
+
+class TestProgress(unittest.TestCase):
+    def test_event_stream(self):
+        out = io.StringIO()
+        progress = p.EventStream(out, interval=0)
+        progress.start('packaging', 3)
+        for _ in range(3):
+            progress.advance(1, 100)
+        progress.finish()
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([e['event'] for e in events],
+                         ['start', 'progress', 'progress', 'progress', 'finish'])
+        self.assertEqual(events[0], {'event': 'start', 'stage': 'packaging', 'total': 3})
+        self.assertEqual((events[-1]['done'], events[-1]['bytes']), (3, 300))
+
+    def test_rate_limited(self):
+        out = io.StringIO()
+        progress = p.EventStream(out, interval=3600)
+        progress.start('zipping', 1000)
+        for _ in range(1000):
+            progress.advance(1, 10)
+        progress.finish()
+        events = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([e['event'] for e in events], ['start', 'finish'])
+        self.assertEqual(events[-1]['done'], 1000)
+
+    def test_progress_bar(self):
+        out = io.StringIO()
+        progress = p.ProgressBar(out, interval=0)
+        progress.start('packaging', 2)
+        progress.advance(1, 2048)
+        progress.advance(1, 2048)
+        progress.finish()
+        # only the finished stage is written on a stream which is not a terminal
+        self.assertRegex(out.getvalue(), r'^packaging: 2 items, 4.0 KiB in [0-9.]+s \(.*\)\n$')
+
+        out = _Terminal()
+        progress = p.ProgressBar(out, interval=0, width=4)
+        progress.start('zipping', 4)
+        progress.advance(1, 10)
+        self.assertIn('\rzipping [#...] 1/4 ', out.getvalue())
+        self.assertIn(' ETA 0:00:0', out.getvalue())
+        progress.finish()
+        self.assertTrue(out.getvalue().endswith('\x1b[K\n'))
+
+    def test_progress_group(self):
+        outs = [io.StringIO(), io.StringIO()]
+        progress = p.ProgressGroup(*[p.EventStream(out, interval=0) for out in outs])
+        progress.start('packaging', 1)
+        progress.advance()
+        progress.finish()
+        self.assertEqual(outs[0].getvalue(), outs[1].getvalue())
+        self.assertEqual(len(outs[0].getvalue().splitlines()), 3)
@@ -1,5 +1,6 @@
 import unittest, logging
-import pathlib, uuid
+import pathlib, uuid, asyncio, io, os, shutil, tempfile
+from unittest import mock
 
 import tinypublisher.reader as r
 import tinypublisher.package as p
@@ -54,5 +55,115 @@ class TestFileListParser(unittest.TestCase):
         self.spec.uuid = 'osmatsuda.sakura.ne.jp'
         self.assertEqual(self.spec.id, uuid.uuid5(uuid.NAMESPACE_DNS, 'osmatsuda.sakura.ne.jp').urn)
 
+    def test_parse_async(self):
+        specfile = self.parser.curdir / 'spine.tsv'
+        with open(specfile) as f:
+            spec = asyncio.run(self.parser.parse_async(f, maxsize=1))
+        self.assertEqual(spec.spine, self.spec.spine)
+
+        broken = io.TextIOWrapper(io.BytesIO(b'01.png\n\xff\n'), encoding='utf-8')
+        with self.assertRaises(UnicodeDecodeError):
+            asyncio.run(asyncio.wait_for(self.parser.parse_async(broken), 10))
+
+    def test_parse_dir(self):
+        self.assertTrue(r._natural_key('p10.jpg') > r._natural_key('p9.jpg'))
+        self.assertTrue(r._natural_key('p1².jpg') < r._natural_key('p2.jpg'))
+
+        entries = list(r.scan_dir(self.curdir, exclude=['cover.png', 'mark3.svg', 'star*']))
+        self.assertEqual(entries, [['01.png'], ['02.xhtml'], ['03.svg'], ['04.svg'], ['05.jpg']])
+        self.assertEqual(list(r.scan_dir(self.curdir, include=['*.css', '*.js'], titles=True)),
+                         [['02.js', '02'], ['style.css', 'style']])
+
+        spec = self.parser.parse_dir(include=['0*'], exclude=['*.js'], titles=True)
+        self.assertEqual([item.index_title for item in spec.spine],
+                         ['01', '02', '03', '04', '05'])
+        self.assertEqual(spec.spine[1].content_includes, self.spec.spine[1].content_includes)
+
+        # the names of the same key are in order, and the links to dirs are not followed
+        with tempfile.TemporaryDirectory() as tmp:
+            curdir = pathlib.Path(tmp)
+            for name in ['1.jpg', '01.jpg', 'sub/a.png']:
+                (curdir / name).parent.mkdir(exist_ok=True)
+                (curdir / name).touch()
+            (curdir / 'sub/loop').symlink_to('..')
+            self.assertEqual(list(r.scan_dir(curdir)), [['01.jpg'], ['1.jpg'], ['sub/a.png']])
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            curdir = pathlib.Path(tmp) / 'assets'
+            shutil.copytree(self.curdir, curdir, ignore=shutil.ignore_patterns('build'))
+            snapshot = io.BytesIO()
+            with open(curdir / 'spine.tsv') as f:
+                spec = r.FileListParser(curdir).compile(f, snapshot)
+
+            with mock.patch.object(r, '_check_file_type', wraps=r._check_file_type) as check:
+                snapshot.seek(0)
+                self.assertEqual(r.load_snapshot(snapshot).spine, spec.spine)
+                self.assertEqual(check.call_count, 0)
+
+                style = curdir / 'style.css'
+                st = style.stat()
+                os.utime(style, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+                snapshot.seek(0)
+                self.assertEqual(r.load_snapshot(snapshot).spine, spec.spine)
+                self.assertEqual([call.args[0].name for call in check.call_args_list], ['02.xhtml'])
+
+        with self.assertRaises(r.SnapshotError):
+            r.load_snapshot(io.BytesIO(b'01.png\tThe first page\n'))
+        with self.assertRaises(r.SnapshotError):
+            r.load_snapshot(io.BytesIO(snapshot.getvalue()[:len(r.SNAPSHOT_MAGIC) + 1]))
+
+    def test_limits(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            curdir = pathlib.Path(tmp) / 'assets'
+            shutil.copytree(self.curdir, curdir, ignore=shutil.ignore_patterns('build'))
+            (curdir / 'deep.svg').write_text('<svg xmlns="http://www.w3.org/2000/svg">' +
+                                             '<g>' * 300 + '</g>' * 300 + '</svg>')
+            def parse(text, **limits):
+                parser = r.FileListParser(curdir, r.InspectionLimits(**limits))
+                return parser.parse_text(text)
+
+            self.assertEqual(len(parse('01.png\n02.xhtml\n', max_elements=100).spine), 2)
+            def violation(text, **limits):
+                with self.assertRaises(r.ReaderError) as cm:
+                    parse(text, **limits)
+                return cm.exception.message
+
+            self.assertRegex(violation('01.png\n02.xhtml\n', max_elements=10),
+                             r'02\.xhtml" has more than 10 elements\. \[pos: 1,0\]$')
+            self.assertRegex(violation('deep.svg\n'), r'deeper than 256\. \[pos: 0,0\]$')
+            # the linked resources are checked against the limits too
+            size = (curdir / 'style.css').stat().st_size
+            self.assertRegex(violation('02.xhtml\n', max_bytes=size - 1),
+                             r'style\.css" is larger than \d+ bytes')
+            self.assertRegex(violation('02.xhtml\n', max_seconds=-1), r'takes longer than')
+
+            # a document which expat rejects is a violation at the entry
+            entities = ''.join(f'<!ENTITY e{i} "{f"&e{i - 1};" * 10}">' for i in range(1, 10))
+            (curdir / 'laughs.xhtml').write_text(
+                f'<?xml version="1.0"?><!DOCTYPE html [<!ENTITY e0 "ha">{entities}]>'
+                '<html xmlns="http://www.w3.org/1999/xhtml"><body><p>&e9;</p></body></html>')
+            self.assertRegex(violation('01.png\nlaughs.xhtml\n'),
+                             r'laughs\.xhtml" cannot be parsed: .*amplification.* \[pos: 1,0\]$')
+            (curdir / 'broken.svg').write_text('<svg xmlns="http://www.w3.org/2000/svg"><g></svg>')
+            self.assertRegex(violation('broken.svg\n'), r'broken\.svg" cannot be parsed: mismatched tag')
+
+            # the style sheets importing each other are inspected once
+            (curdir / 'a.css').write_text('@import url("b.css");')
+            (curdir / 'b.css').write_text('@import url("a.css");')
+            (curdir / 'cycle.xhtml').write_text(
+                '<?xml version="1.0"?><html xmlns="http://www.w3.org/1999/xhtml"><head><title>Cycle</title>'
+                '<link rel="stylesheet" href="a.css"/></head><body/></html>')
+            includes = parse('cycle.xhtml\n').spine[0].content_includes
+            self.assertEqual([pathlib.Path(path).name for path, _ in includes], ['a.css', 'b.css'])
+
+            # an entry and its linked resources share one deadline
+            with mock.patch.object(r, '_Guard', wraps=r._Guard) as guard:
+                parse('02.xhtml\n03.svg\n')
+            deadlines: dict[float, set[str]] = {}
+            for call in guard.call_args_list:
+                deadlines.setdefault(call.args[3], set()).add(call.args[0].name)
+            self.assertEqual(sorted(deadlines.values(), key=len), [{'03.svg'}, {'02.xhtml', 'style.css', 'mark3.svg'}])
+
 if __name__ == '__main__':
     unittest.main()
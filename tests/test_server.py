@@ -0,0 +1,108 @@
+import unittest
+import pathlib, shutil, tempfile, threading, io, zipfile, logging
+import urllib.request, urllib.error
+from unittest import mock
+
+import tinypublisher as app
+import tinypublisher.server as s
+import tinypublisher.server.loadgen as loadgen
+
+
+class TestServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        logging.getLogger(app.__appname__).setLevel(logging.WARNING)
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.root = pathlib.Path(cls.tmpdir.name)
+        shutil.copytree(pathlib.Path(__file__).parent / 'assets', cls.root / 'assets',
+                        ignore=shutil.ignore_patterns('build'))
+        cls.server = s.BuildServer(('127.0.0.1', 0), cls.root, workers=2)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.thread.join()
+        cls.server.server_close()
+        cls.tmpdir.cleanup()
+
+    def post(self, query, body, content_type):
+        request = urllib.request.Request(f'{self.url}/build?{query}', body,
+                                         {'Content-Type': content_type})
+        return urllib.request.urlopen(request)
+
+    def test_file_list(self):
+        spine = (self.root / 'assets/spine.tsv').read_bytes()
+        with self.post('name=served&dir=assets&title=Served', spine, 'text/tab-separated-values') as res:
+            timings = loadgen._parse_server_timing(res.headers['Server-Timing'])
+            epub = res.read()
+        self.assertEqual(set(timings), {'extract', 'parse', 'build', 'zip', 'queue', 'total'})
+        with zipfile.ZipFile(io.BytesIO(epub)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertIn('<dc:title>Served</dc:title>', zf.read('book/package.opf').decode())
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.post('dir=..', spine, 'text/tab-separated-values')
+        self.assertEqual(cm.exception.code, 400)
+
+    def test_sources(self):
+        sources = loadgen.zip_sources(self.root / 'assets')
+        report = loadgen.run(self.url, sources, 'application/zip', 4, 2, {'name': 'uploaded'})
+        self.assertEqual((report.requests, report.failures), (4, 0))
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.post('spine=missing.tsv', sources, 'application/zip')
+        self.assertEqual(cm.exception.code, 422)
+
+    def test_rejects(self):
+        spine = (self.root / 'assets/spine.tsv').read_bytes()
+        for query in ('name=../book&dir=assets', 'name=.hidden&dir=assets'):
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                self.post(query, spine, 'text/tab-separated-values')
+            self.assertEqual(cm.exception.code, 400)
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.post('name=cover&dir=assets&cover=../../etc/passwd', spine,
+                      'text/tab-separated-values')
+        self.assertEqual(cm.exception.code, 422)
+
+        # no file outside the dir is read or inspected
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.post('dir=assets', b'../../../etc/passwd\n', 'text/tab-separated-values')
+        self.assertEqual(cm.exception.code, 422)
+        self.assertNotIn(b'supported', cm.exception.read())
+        sources = loadgen.zip_sources(self.root / 'assets')
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.post('spine=../../../etc/passwd', sources, 'application/zip')
+        self.assertEqual(cm.exception.code, 422)
+        self.assertNotIn(b'root:', cm.exception.read())
+
+        with mock.patch.object(s, '_MAX_BODY', 16):
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                self.post('dir=assets', spine, 'text/tab-separated-values')
+            self.assertEqual(cm.exception.code, 413)
+
+    def test_extract(self):
+        sources = loadgen.zip_sources(self.root / 'assets')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch.object(s, '_MAX_SOURCES_MEMBERS', 1):
+                with self.assertRaises(s.ServerError):
+                    s._extract(sources, pathlib.Path(tmpdir))
+            with mock.patch.object(s, '_MAX_SOURCES_SIZE', 1024):
+                with self.assertRaises(s.ServerError):
+                    s._extract(sources, pathlib.Path(tmpdir))
+            self.assertEqual(list(pathlib.Path(tmpdir).iterdir()), [])
+
+    def test_parsers(self):
+        with mock.patch.object(s, '_MAX_PARSERS', 2), \
+             mock.patch.object(s, '_parsers', s.OrderedDict()):
+            first = s._parser('a', None)
+            s._parser('b', None)
+            self.assertIs(s._parser('a', None), first)
+            s._parser('c', None)
+            self.assertEqual(list(s._parsers), ['a', 'c'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import pathlib, shutil, tempfile, logging, os
+from unittest import mock
+
+import tinypublisher.builder as b
+import tinypublisher.reader as r
+import tinypublisher.watcher as w
+
+
+class TestWatcher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        r.logger.setLevel(logging.WARNING)
+        b.logger.setLevel(logging.WARNING)
+        w.logger.setLevel(logging.WARNING)
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.curdir = pathlib.Path(self.tmpdir.name) / 'assets'
+        shutil.copytree(pathlib.Path(__file__).parent / 'assets', self.curdir,
+                        ignore=shutil.ignore_patterns('build'))
+        self.watcher = w.Watcher(self.curdir / 'spine.tsv', 'test')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def touch(self, path: pathlib.Path, text: str):
+        st = path.stat()
+        path.write_text(text)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def test_poll(self):
+        self.watcher.build()
+        self.assertFalse(self.watcher.poll())
+
+        inspected = self.watcher.parser.inspected[str((self.curdir / '01.png').resolve())]
+        self.touch(self.curdir / 'style.css', '/* modified */\n' + (self.curdir / 'style.css').read_text())
+        self.assertTrue(self.watcher.poll())
+        self.assertIs(self.watcher.parser.inspected[str((self.curdir / '01.png').resolve())],
+                      inspected)
+        self.assertTrue((self.watcher.builder.destdir / 'book/items/style.css')
+                        .read_text().startswith('/* modified */'))
+
+        self.touch(self.curdir / 'spine.tsv', '01.png\tThe first page\n')
+        self.assertTrue(self.watcher.poll())
+        items_dir = self.watcher.builder.destdir / 'book/items'
+        self.assertEqual(sorted(p.name for p in items_dir.iterdir()),
+                         ['01.png', '01.png.xhtml', 'tinypublisherG1.css'])
+        self.assertFalse(self.watcher.poll())
+
+    def test_missing_link(self):
+        (self.curdir / 'style.css').unlink()
+        with self.assertLogs('tinypublisher.reader', 'WARNING'):
+            self.watcher.build()
+        self.assertFalse(self.watcher.poll())
+
+        # a missing file linked is watched, and inspected when it is made
+        (self.curdir / 'style.css').write_text('p { margin: 0 }\n')
+        self.assertTrue(self.watcher.poll())
+        self.assertTrue((self.watcher.builder.destdir / 'book/items/style.css').is_file())
+        self.assertFalse(self.watcher.poll())
+
+    def test_options(self):
+        watcher = w.Watcher(self.curdir / 'spine.tsv', 'test-options', jobs=2, cache_size=0)
+        with mock.patch.object(watcher.builder, 'zipup') as zipup:
+            watcher.build()
+        zipup.assert_called_once_with(2, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,57 @@
-import logging
+import asyncio, logging
+from typing import Any, AsyncIterator, Callable, Iterable, Optional
+from collections.abc import Collection
+from concurrent.futures import Executor
 
 __version__ = "0.3.2"
 __appname__ = 'tinypublisher'
 
 # Logger
+# the handler is added by the command, not to print the logs of the
+# applications which use this package as a library
 logger = logging.getLogger(__appname__)
-logger.setLevel(logging.INFO)
-_handler = logging.StreamHandler()
-_formatter = logging.Formatter('%(name)s.%(levelname)s: %(message)s')
-_handler.setFormatter(_formatter)
-logger.addHandler(_handler)
 
 
 class AppBaseError(Exception):
     pass
 
+
+
+async def executor_map(fn: Callable[[Any], Any], iterable: Iterable,
+                       executor: Optional[Executor] = None, maxsize: int = 64) -> AsyncIterator:
+    """Yields `fn(x)` for each `x` of `iterable` in order. Each call runs on the
+    `executor` and at most `maxsize` calls are queued ahead of the consumer.
+    The `iterable` is advanced on a thread unless it is a collection in
+    memory, since it may read a file, and an error raised by it is raised to
+    the consumer."""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize)
+    iterator = iter(iterable)
+    end = object()
+
+    async def advance() -> Any:
+        if isinstance(iterable, Collection):
+            return next(iterator, end)
+        return await loop.run_in_executor(None, next, iterator, end)
+
+    async def produce() -> None:
+        try:
+            while (x := await advance()) is not end:
+                await queue.put(loop.run_in_executor(executor, fn, x))
+        except Exception as e:
+            failed = loop.create_future()
+            failed.set_exception(e)
+            await queue.put(failed)
+        await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (future := await queue.get()) is not None:
+            yield await future
+        await producer
+    finally:
+        producer.cancel()
+        while not queue.empty():
+            future = queue.get_nowait()
+            if future is not None:
+                future.cancel()
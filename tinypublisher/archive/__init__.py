@@ -0,0 +1,406 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from typing import BinaryIO, Callable, Iterable, Optional
+import contextlib, datetime, hashlib, io, os, struct, tempfile, zipfile, zlib
+
+import tinypublisher as app
+
+import logging
+logger = logging.getLogger(f'{app.__appname__}.archive')
+
+
+STORED = 0
+DEFLATED = 8
+
+DateTime = tuple[int, int, int, int, int, int]
+
+# members larger than this are compressed in the writing process chunk by
+# chunk, instead of being passed to a worker as a whole
+STREAMED_SIZE = 16 * 1024 * 1024
+_CHUNK_SIZE = 1024 * 1024
+
+# the default total size of the entries of a member cache
+MEMBER_CACHE_SIZE = 256 * 1024 * 1024
+# the head of an entry of a member cache: the compression type, the CRC-32
+# and the size of the content
+_CACHE_ENTRY = struct.Struct('<BII')
+
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP64_COUNT_LIMIT = 0xFFFF
+
+
+@dataclass
+class Member:
+    name: str
+    crc: int
+    file_size: int
+    compress_type: int
+    data: bytes
+    date_time: DateTime
+    # whether the data was taken from a member cache
+    cached: bool = False
+
+    @property
+    def compress_size(self) -> int:
+        return len(self.data)
+
+
+@dataclass
+class MemberInfo:
+    name: str
+    file_size: int
+    compress_size: int
+    compress_type: int
+
+    @property
+    def ratio(self) -> float:
+        """The compressed size per the original size."""
+        return self.compress_size / self.file_size if self.file_size else 1.0
+
+
+@dataclass
+class _Entry:
+    name: bytes
+    flags: int
+    crc: int
+    file_size: int
+    compress_size: int
+    compress_type: int
+    date_time: DateTime
+    offset: int
+
+
+class ArchiveError(app.AppBaseError):
+    def __init__(self, message: str):
+        self.message = message
+
+
+class ArchiveWriter:
+    """Writes a zip archive from members which are already compressed, in the
+    order they are added. The zip64 extensions are used only if needed."""
+
+    def __init__(self, fileobj: BinaryIO,
+                 on_member: Optional[Callable[[MemberInfo], None]] = None) -> None:
+        self.fp = fileobj
+        self.entries: list[_Entry] = []
+        self.names: set[bytes] = set()
+        # called with each member written
+        self.on_member = on_member
+
+    def __enter__(self) -> ArchiveWriter:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if exc[0] is None:
+            self.close()
+
+    def add(self, member: Member) -> None:
+        entry = self._entry(member.name, member.crc, member.file_size,
+                            len(member.data), member.compress_type, member.date_time)
+        self.fp.write(_local_header(entry))
+        self.fp.write(member.data)
+        self._append(entry)
+
+    def add_file(self, name: str, path: Path, compress_type: int = DEFLATED,
+                 level: int = -1, date_time: Optional[DateTime] = None) -> None:
+        """Compresses and writes the file chunk by chunk. The header is
+        written again when the sizes and the CRC are known."""
+        st = path.stat()
+        entry = self._entry(name, 0, st.st_size, st.st_size, compress_type,
+                            date_time or _date_time_of(st.st_mtime))
+        # deflate may make incompressible data a little larger
+        zip64 = entry.file_size + entry.file_size // 100 + 1024 >= _ZIP64_LIMIT
+        self.fp.write(_local_header(entry, zip64))
+
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if compress_type == DEFLATED else None
+        crc = size = compress_size = 0
+        with open(path, 'rb') as f:
+            while chunk := f.read(_CHUNK_SIZE):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                self.fp.write(chunk)
+                compress_size += len(chunk)
+            if compressor:
+                chunk = compressor.flush()
+                self.fp.write(chunk)
+                compress_size += len(chunk)
+
+        if size != entry.file_size:
+            raise ArchiveError(f'"{path}" was modified while it was archived.')
+        entry.crc, entry.compress_size = crc, compress_size
+        end = self.fp.tell()
+        self.fp.seek(entry.offset)
+        self.fp.write(_local_header(entry, zip64))
+        self.fp.seek(end)
+        self._append(entry)
+
+    def add_raw(self, info: zipfile.ZipInfo, src: BinaryIO) -> None:
+        """Copies a member of another archive `src` without recompressing it."""
+        if info.flag_bits & 0x1:
+            raise ArchiveError(f'Encrypted member "{info.filename}" cannot be copied.')
+        src.seek(info.header_offset)
+        header = src.read(30)
+        if header[:4] != b'PK\x03\x04':
+            raise ArchiveError(f'Bad local header of "{info.filename}".')
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        src.seek(name_len + extra_len, io.SEEK_CUR)
+
+        entry = self._entry(info.filename, info.CRC, info.file_size, info.compress_size,
+                            info.compress_type, info.date_time)
+        self.fp.write(_local_header(entry))
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = src.read(min(remaining, _CHUNK_SIZE))
+            if not chunk:
+                raise ArchiveError(f'Truncated member "{info.filename}".')
+            self.fp.write(chunk)
+            remaining -= len(chunk)
+        self._append(entry)
+
+    def infolist(self) -> list[MemberInfo]:
+        """The sizes of the members written so far, in order."""
+        return [_member_info(entry) for entry in self.entries]
+
+    def _append(self, entry: _Entry) -> None:
+        self.entries.append(entry)
+        if self.on_member:
+            self.on_member(_member_info(entry))
+
+    def close(self) -> None:
+        start = self.fp.tell()
+        for entry in self.entries:
+            self.fp.write(_central_header(entry))
+        size = self.fp.tell() - start
+        count = len(self.entries)
+
+        if count > _ZIP64_COUNT_LIMIT or start > _ZIP64_LIMIT or size > _ZIP64_LIMIT:
+            zip64_end = self.fp.tell()
+            self.fp.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                                      count, count, size, start))
+            self.fp.write(struct.pack('<IIQI', 0x07064b50, 0, zip64_end, 1))
+            count = min(count, _ZIP64_COUNT_LIMIT)
+            size = min(size, _ZIP64_LIMIT)
+            start = min(start, _ZIP64_LIMIT)
+        self.fp.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, size, start, 0))
+
+    def _entry(self, name: str, crc: int, file_size: int, compress_size: int,
+               compress_type: int, date_time: DateTime) -> _Entry:
+        encoded = name.encode('utf-8')
+        if encoded in self.names:
+            raise ArchiveError(f'Duplicate member "{name}".')
+        self.names.add(encoded)
+        flags = 0 if name.isascii() else 0x800
+        return _Entry(encoded, flags, crc, file_size, compress_size, compress_type,
+                      date_time, self.fp.tell())
+
+
+def _member_info(entry: _Entry) -> MemberInfo:
+    return MemberInfo(entry.name.decode('utf-8'), entry.file_size, entry.compress_size,
+                      entry.compress_type)
+
+def _dos_date_time(date_time: DateTime) -> tuple[int, int]:
+    y, mo, d, h, mi, s = date_time
+    return (h << 11 | mi << 5 | s // 2), ((y - 1980) << 9 | mo << 5 | d)
+
+def _date_time_of(timestamp: float) -> DateTime:
+    t = datetime.datetime.fromtimestamp(timestamp)
+    if t.year < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    return (t.year, t.month, t.day, t.hour, t.minute, t.second)
+
+def _local_header(entry: _Entry, zip64: bool = False) -> bytes:
+    zip64 = zip64 or entry.file_size >= _ZIP64_LIMIT or entry.compress_size >= _ZIP64_LIMIT
+    extra = b''
+    file_size, compress_size = entry.file_size, entry.compress_size
+    if zip64:
+        extra = struct.pack('<HHQQ', 0x0001, 16, file_size, compress_size)
+        file_size = compress_size = _ZIP64_LIMIT
+    dostime, dosdate = _dos_date_time(entry.date_time)
+    return struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if zip64 else 20, entry.flags,
+                       entry.compress_type, dostime, dosdate, entry.crc,
+                       compress_size, file_size, len(entry.name), len(extra)) + entry.name + extra
+
+def _central_header(entry: _Entry) -> bytes:
+    fields = []
+    file_size, compress_size, offset = entry.file_size, entry.compress_size, entry.offset
+    if file_size >= _ZIP64_LIMIT or compress_size >= _ZIP64_LIMIT:
+        fields += [file_size, compress_size]
+        file_size = compress_size = _ZIP64_LIMIT
+    if offset >= _ZIP64_LIMIT:
+        fields.append(offset)
+        offset = _ZIP64_LIMIT
+    extra = struct.pack(f'<HH{len(fields)}Q', 0x0001, 8 * len(fields), *fields) if fields else b''
+    dostime, dosdate = _dos_date_time(entry.date_time)
+    return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | 45 if extra else 3 << 8 | 20,
+                       45 if extra else 20, entry.flags, entry.compress_type, dostime, dosdate,
+                       entry.crc, compress_size, file_size, len(entry.name), len(extra), 0,
+                       0, 0, 0o100644 << 16, offset) + entry.name + extra
+
+
+
+# Compression
+
+@dataclass
+class Task:
+    name: str
+    path: Path
+    compress_type: int = DEFLATED
+    level: int = -1
+    date_time: Optional[DateTime] = None
+
+def compress(task: Task, cache: Optional[MemberCache] = None) -> Member:
+    """Reads and compresses the file. If the deflate doesn't make it smaller,
+    the member is stored. The deflated data is reused from the `cache` if
+    it has the same content."""
+    data = task.path.read_bytes()
+    date_time = task.date_time or _date_time_of(task.path.stat().st_mtime)
+    if cache and task.compress_type == DEFLATED:
+        return cache.compress(task.name, data, date_time, task.level)
+    return compress_bytes(task.name, data, date_time, task.compress_type, task.level)
+
+def compress_bytes(name: str, data: bytes, date_time: DateTime,
+                   compress_type: int = DEFLATED, level: int = -1) -> Member:
+    crc = zlib.crc32(data)
+    if compress_type == DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        if len(deflated) < len(data):
+            return Member(name, crc, len(data), DEFLATED, deflated, date_time)
+    return Member(name, crc, len(data), STORED, data, date_time)
+
+def write_zip(fileobj: BinaryIO, tasks: Iterable[Task], jobs: int = 1,
+              on_member: Optional[Callable[[MemberInfo], None]] = None,
+              cache: Optional[MemberCache] = None) -> ArchiveWriter:
+    """Writes the files of the `tasks` into a zip archive in order. The files
+    are compressed on a pool of `jobs` processes, and at most a few times
+    `jobs` members are held waiting to be written. The large files are
+    compressed by this process while streaming. `on_member` is called with
+    each member written. The members which are not streamed are compressed
+    through the `cache`, which is pruned afterwards."""
+    writer = ArchiveWriter(fileobj, on_member)
+    write_files(writer, tasks, jobs, cache)
+    writer.close()
+    return writer
+
+def write_files(writer: ArchiveWriter, tasks: Iterable[Task], jobs: int = 1,
+                cache: Optional[MemberCache] = None) -> None:
+    """`write_zip` into the `writer` without closing it."""
+    pool = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    with pool or contextlib.nullcontext():
+        window: deque = deque()
+        def drain(limit: int) -> None:
+            while len(window) > limit:
+                writer.add(window.popleft().result())
+
+        for task in tasks:
+            if task.path.stat().st_size > STREAMED_SIZE:
+                drain(0)
+                writer.add_file(task.name, task.path, task.compress_type, task.level, task.date_time)
+            elif pool is None:
+                writer.add(compress(task, cache))
+            else:
+                window.append(pool.submit(compress, task, cache))
+                drain(jobs * 4)
+        drain(0)
+    if cache:
+        cache.prune()
+
+
+# Member cache
+
+@dataclass
+class MemberCache:
+    """Compressed members kept in a dir across builds, keyed by the SHA-256 of
+    the content and the compression level, so that the same content is not
+    compressed again in any package. When the entries are larger than
+    `max_bytes` in total, the least recently used ones are removed by
+    `prune`. The entries are written atomically and checked against the
+    content when used, and the cache may be shared by processes."""
+    root: Path
+    max_bytes: int = MEMBER_CACHE_SIZE
+
+    def compress(self, name: str, data: bytes, date_time: DateTime, level: int = -1) -> Member:
+        """`compress_bytes` deflating the `data`, or the member from the cached
+        entry of the same content."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.root / digest[:2] / f'{digest}-{level}'
+        crc = zlib.crc32(data)
+        try:
+            entry = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            entry = b''
+        if entry:
+            compress_type = _checked_entry(entry, crc, len(data))
+            if compress_type == DEFLATED:
+                return Member(name, crc, len(data), DEFLATED,
+                              entry[_CACHE_ENTRY.size:], date_time, True)
+            if compress_type == STORED:
+                return Member(name, crc, len(data), STORED, data, date_time, True)
+            logger.debug(f'dropping a broken entry of the member cache: {path}')
+            with contextlib.suppress(OSError):
+                path.unlink()
+
+        member = compress_bytes(name, data, date_time, DEFLATED, level)
+        # the deflated data follows the head, if deflated
+        entry = _CACHE_ENTRY.pack(member.compress_type, crc, len(data))
+        if member.compress_type == DEFLATED:
+            entry += member.data
+        tmp = None
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(entry)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f'The member cache cannot be written: {e}')
+            if tmp:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp)
+        return member
+
+    def prune(self) -> None:
+        """Removes the least recently used entries until the rest fit in
+        `max_bytes`."""
+        entries = []
+        for path in self.root.glob('*/*'):
+            if path.suffix == '.tmp':
+                # being written by another process
+                continue
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, str(path)))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            total -= size
+
+def _checked_entry(entry: bytes, crc: int, file_size: int) -> Optional[int]:
+    """The compression type of the cache entry, or None if the entry is not
+    of the content of the `crc` and the `file_size`."""
+    if len(entry) < _CACHE_ENTRY.size:
+        return None
+    compress_type, entry_crc, entry_size = _CACHE_ENTRY.unpack_from(entry)
+    if (entry_crc, entry_size) != (crc, file_size):
+        return None
+    if compress_type == STORED and len(entry) == _CACHE_ENTRY.size:
+        return STORED
+    if compress_type == DEFLATED:
+        try:
+            inflated = zlib.decompress(entry[_CACHE_ENTRY.size:], -15)
+        except zlib.error:
+            return None
+        if (zlib.crc32(inflated), len(inflated)) == (crc, file_size):
+            return DEFLATED
+    return None
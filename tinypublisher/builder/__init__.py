@@ -1,13 +1,22 @@
 from __future__ import annotations
-from dataclasses import dataclass, asdict
-from pathlib import Path
-from zipfile import ZipFile, ZIP_DEFLATED
+from dataclasses import dataclass, field, asdict, astuple
+from functools import lru_cache
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
 import xml.etree.ElementTree as ET
 from mako.template import Template # type: ignore
-from typing import Union, Any, Generator, Optional
-import datetime, magic, urllib.parse
+from mako.runtime import Context # type: ignore
+from typing import Union, Any, Generator, Iterator, Optional, TextIO
+from concurrent.futures import Executor, ThreadPoolExecutor
+import asyncio, queue, threading
+import datetime, hashlib, magic, posixpath, re, shutil, tempfile, urllib.parse
+from xml.sax.saxutils import escape as _escape
+from zipfile import ZipFile
 
 import tinypublisher as app
+import tinypublisher.archive as archive
+import tinypublisher.minify as minify
+from tinypublisher.progress import Progress
 from tinypublisher.package import PackageSpec, SpineItem, MediaType
 
 import logging
@@ -21,10 +30,23 @@ class BuilderError(app.AppBaseError):
 _BUILD_DIR_NAME_ = 'build'
     
 class PackageBuilder():
-    def __init__(self, pkgname: str) -> None:
+    def __init__(self, pkgname: str, progress: Optional[Progress] = None) -> None:
         if pkgname.endswith('.epub'):
             pkgname = pkgname[:pkgname.index('.epub')]
         self.packagename = pkgname
+        self.reproducible = False
+        self.minify = False
+        # path in the package -> the sizes before and after minified
+        self.minified: dict[str, tuple[int, int]] = {}
+        # href -> what the item was made from, to skip unchanged items in rebuilding
+        self.packaged: dict[str, Any] = {}
+        self.css_href: Optional[str] = None
+        self.css_written: set[Path] = set()
+        self.lock = threading.RLock()
+        # the members of the EPUB file made by the last `zipup`
+        self.archived: list[archive.MemberInfo] = []
+        self.logger = logging.LoggerAdapter(logger, {'package': self.packagename})
+        self.progress = progress or Progress()
 
     def build_with(self, spec: PackageSpec) -> None: # failable
         self.make_package_dirs(spec.curdir)
@@ -54,148 +76,739 @@ class PackageBuilder():
     def make_package_document(self, spec: PackageSpec) -> None:
         assert self.destdir is not None
         
+        self.reproducible = spec.reproducible
+        if spec.minify != self.minify:
+            # the style sheets written with the other setting are written again
+            self.css_written.clear()
+            self.minified.clear()
+        self.minify = spec.minify
+        self.css_href = _css_href(spec.spine)
         pkg_doc_spec: dict[str, Any] = _make_pkg_doc_spec(spec, self.destdir.name)
-        pkg_doc_spec['pkg_items'] = _make_pkg_doc_items(spec.spine, self.curdir.resolve())
+        manifest = _make_pkg_doc_items(spec.spine, self.curdir.resolve(), spec.images_per_page)
         if spec.cover_image:
-            _pkg_doc_add_cover_image(spec.cover_image, pkg_doc_spec, self.curdir)
+            _pkg_doc_add_cover_image(spec.cover_image, manifest, self.curdir)
+        pkg_doc_spec['manifest'] = manifest
+        pkg_doc_spec['pkg_items'] = manifest.items
+        pkg_doc_spec['nav_points'] = _nav_points(manifest.items, spec.nav_folders, spec.nav_chunk)
+        pkg_doc_spec['page_list'] = _page_list(manifest.items) if spec.page_list else []
         self.package_document_spec = pkg_doc_spec
 
         pkg_opf = self.destdir / 'book/package.opf'
-        template = _template(pkg_opf.name)
 
-        logger.info(f'making a Package Document\n  -- {str(pkg_opf)}')
+        self.logger.info(f'making a Package Document\n  -- {str(pkg_opf)}')
         with open(pkg_opf, 'w') as f:
-            f.write(template.render(**self.package_document_spec))
+            _render_to(f, pkg_opf.name, **self.package_document_spec)
 
     def make_navigation_document(self, spec: PackageSpec) -> None:
         if self.__dict__.get('package_document_spec') is None:
             self.make_package_document(spec)
 
         nav_xhtml = self.destdir / 'book/navigation.xhtml'
-        template = _template(nav_xhtml.name)
 
-        logger.info(f'making a Navigation Document\n  -- {str(nav_xhtml)}')
-        with open(nav_xhtml, 'w') as f:
-            f.write(template.render(**self.package_document_spec))
+        self.logger.info(f'making a Navigation Document\n  -- {str(nav_xhtml)}')
+        with self.output(nav_xhtml, MediaType.XHTML.value) as f:
+            _render_to(f, nav_xhtml.name, **self.package_document_spec)
 
     def package_content_items(self, spec: PackageSpec) -> None:
         if self.__dict__.get('package_document_spec') is None:
             self.make_package_document(spec)
 
-        for item in self.package_document_spec['pkg_items']:
-            target = self.destdir / 'book' / item.href
-            if item.spine_item_p and item.src_path is None:
-                _make_wrapping_doc(spec, item, target)
+        items = self.package_document_spec['pkg_items']
+        self.progress.start('packaging', len(items))
+        for item in items:
+            self.progress.advance(1, self.package_content_item(spec, item))
+        self.progress.finish()
+        self.remove_stale_items()
+        self.log_minified()
+
+    def package_content_item(self, spec: PackageSpec, item: _ManifestItem) -> int:
+        """Copies or makes the item, and returns its size. It is skipped if
+        this builder has already packaged the item from the same source, and
+        0 is returned."""
+        target = self.destdir / 'book' / item.href
+        if item.spine_item_p and item.src_path is None:
+            doc_spec = _wrapping_doc_spec(item, spec)
+            if self.css_href is None:
+                self.css_href = _css_href(spec.spine)
+            doc_spec.css_href = self.css_href
+            origin: Any = (self.minify, astuple(doc_spec),
+                           [_stat_origin(figure.svg) for figure in doc_spec.figures if figure.svg])
+            if self.packaged.get(item.href) == origin and target.exists():
+                return 0
+            self.logger.debug('making a page\n  -- %s', target)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with self.output(target, MediaType.XHTML.value) as f:
+                _make_wrapping_doc(doc_spec, f)
+            self.write_css(target.parent / doc_spec.css_href)
+        else:
+            origin = (self.minify, _stat_origin(item.src_path)) if item.src_path else None
+            if self.packaged.get(item.href) == origin and target.exists():
+                return 0
+            if item.src_path:
+                self.logger.debug('copying "%s" to\n  -- %s', item.href[len('items/'):], target)
+            if self.minify and item.src_path and minify.minifier(item.media_type):
+                target.parent.mkdir(parents=True, exist_ok=True)
+                sizes = minify.minify_file(item.src_path, target, item.media_type)
+                self.record_minified(target, *sizes)
             else:
                 _copy_item(item, target)
+        with self.lock:
+            self.packaged[item.href] = origin
+        return target.stat().st_size if target.exists() else 0
+
+    def write_css(self, target: Path) -> None:
+        """Writes the style sheet of the wrapping pages once for each directory,
+        even if the items are packaged on several threads."""
+        with self.lock:
+            if target in self.css_written and target.exists():
+                return
+            css_template = Path(__file__).parent / 'templates/page.css'
+            with self.output(target, MediaType.CSS.value) as f:
+                f.write(css_template.read_text())
+            self.css_written.add(target)
+
+    @contextmanager
+    def output(self, target: Path, media_type: str) -> Iterator[TextIO]:
+        """Opens the `target` to write a document, which is minified if the
+        spec says so."""
+        with open(target, 'w') as f:
+            m = minify.minifier(media_type) if self.minify else None
+            if m is None:
+                yield f
+                return
+            writer = minify.MinifyingWriter(f, m)
+            yield writer # type: ignore
+            writer.close()
+        self.record_minified(target, writer.original, writer.minified)
+
+    def record_minified(self, target: Path, original: int, minified: int) -> None:
+        name = str(target.relative_to(self.destdir))
+        with self.lock:
+            self.minified[name] = (original, minified)
+
+    def log_minified(self) -> None:
+        if not self.minified:
+            return
+        original = sum(sizes[0] for sizes in self.minified.values())
+        minified = sum(sizes[1] for sizes in self.minified.values())
+        self.logger.info(f'minified {len(self.minified)} documents: {original} -> {minified} bytes '
+                         f'({original - minified} bytes saved)')
+
+    def remove_stale_items(self) -> None:
+        """Removes the items packaged before but no longer in the manifest."""
+        hrefs = {item.href for item in self.package_document_spec['pkg_items']}
+        for href in [href for href in self.packaged if href not in hrefs]:
+            target = self.destdir / 'book' / href
+            self.logger.debug('removing a stale item\n  -- %s', target)
+            target.unlink(missing_ok=True)
+            del self.packaged[href]
+
+    async def build_async(self, spec: PackageSpec, zipped: bool = True,
+                          executor: Optional[Executor] = None, maxsize: int = 64) -> None:
+        """The `build_with` (and `zipup`) of the asyncio version. Blocking works
+        run on the `executor`, and at most `maxsize` content items are queued
+        for copying or rendering while the others are processed.
+
+        Each item packaged is zipped on another thread while the later ones
+        are packaged, so the members are in the order of the manifest, and
+        the other files, like the style sheets of the wrapping pages, follow
+        in sorted order. The `spec` is complete before, since the package
+        document lists every item."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, self.make_package_dirs, spec.curdir)
+        await loop.run_in_executor(executor, self.make_package_document, spec)
+        await loop.run_in_executor(executor, self.make_navigation_document, spec)
+
+        zipping = _ZipWhilePackaging(self) if zipped else None
+        try:
+            package_item = lambda item: self.package_content_item(spec, item)
+            items = self.package_document_spec['pkg_items']
+            self.progress.start('packaging', len(items))
+            hrefs = iter(items)
+            async for size in app.executor_map(package_item, items, executor, maxsize):
+                self.progress.advance(1, size)
+                if zipping:
+                    zipping.add(self.destdir / 'book' / next(hrefs).href)
+            self.progress.finish()
+            self.remove_stale_items()
+            self.log_minified()
+            if zipping:
+                await loop.run_in_executor(executor, zipping.close)
+        except BaseException:
+            if zipping:
+                zipping.abort()
+            raise
     
-    def zipup(self) -> None:
+    def zipup(self, jobs: int = 1, cache_size: int = archive.MEMBER_CACHE_SIZE) -> None:
+        """Makes the EPUB file. The members are compressed on `jobs` processes,
+        and written in sorted order after the stored "mimetype". The deflated
+        members are kept up to `cache_size` bytes in the cache of the build
+        dir, and reused by the packages which have the same contents. If
+        `cache_size` is 0, the cache is not used."""
         zt = self.destdir.parent / (self.packagename + '.epub')
-        logger.info(f'making a EPUB package\n  -- {str(zt)}')
-        with ZipFile(zt, 'w') as zf:
-            _zipwrite(zf, self.destdir, *self.destdir.iterdir())
+        date_time = self.zip_date_time()
+
+        self.logger.info(f'making a EPUB package\n  -- {str(zt)}')
+        mimetype = self.destdir / 'mimetype'
+        tasks = [archive.Task('mimetype', mimetype, archive.STORED, date_time=date_time)]
+        tasks += [archive.Task(str(p.relative_to(self.destdir)), p, date_time=date_time)
+                  for p in _package_files(self.destdir) if p != mimetype]
+        self.progress.start('zipping', len(tasks))
+        with open(zt, 'wb') as f:
+            writer = archive.write_zip(f, tasks, jobs,
+                                       lambda info: self.progress.advance(1, info.file_size),
+                                       _member_cache(self.destdir.parent, cache_size))
+        self.progress.finish()
+        self.archived = writer.infolist()
+
+    def zip_date_time(self) -> Optional[archive.DateTime]:
+        """The date of the members, or None to use the modification times."""
+        if not self.reproducible:
+            return None
+        modified = self.package_document_spec['modified_date']
+        return _zip_date_time(datetime.datetime.fromisoformat(modified[:-1]))
+
+    def plan(self, spec: PackageSpec) -> dict[str, Any]:
+        """The manifest, the spine, the table of contents and the wrapping pages
+        of the package, and its estimated size before compression. Nothing is
+        copied, rendered or written."""
+        curdir = spec.curdir.resolve()
+        metadata = _make_pkg_doc_spec(spec, self.packagename)
+        manifest = _make_pkg_doc_items(spec.spine, curdir, spec.images_per_page)
+        if spec.cover_image:
+            _pkg_doc_add_cover_image(spec.cover_image, manifest, spec.curdir)
+        nav_points = _nav_points(manifest.items, spec.nav_folders, spec.nav_chunk)
+
+        items = []
+        for item in manifest:
+            if item.src_path:
+                size = item.src_path.stat().st_size
+            else:
+                size = _estimated_page_size(item)
+            items.append({
+                'id': item.id,
+                'href': item.href,
+                'media_type': item.media_type,
+                'properties': 'cover-image' if item.cover_image_p else None,
+                'source': str(item.src_path) if item.src_path else None,
+                'bytes': size,
+            })
+        documents = (_ESTIMATED_DOC_SIZE * 2 + _ESTIMATED_ITEM_SIZE * len(manifest) +
+                     _ESTIMATED_NAV_POINT_SIZE * _count_nav_points(nav_points))
+        return {
+            'package': self.packagename,
+            'metadata': {k: v for k, v in metadata.items() if k != 'modified_date'},
+            'manifest': items,
+            'spine': [item.id for item in manifest if item.spine_item_p],
+            'nav': [asdict(point) for point in nav_points],
+            'page_list': len(_page_list(manifest.items)) if spec.page_list else 0,
+            'wrapping_pages': [{'href': item.href, 'figures': [href for href, _ in item.wrapped]}
+                               for item in manifest if item.wrapped],
+            'estimated_bytes': sum(item['bytes'] for item in items) + documents,
+        }
+
+    def size_report(self, spec: PackageSpec, largest: int = 10,
+                    low_savings: float = 0.05) -> dict[str, Any]:
+        """The sizes of the manifest items in the EPUB file made by the last
+        `zipup`, and their totals by the media type and by the spine item with
+        the resources it includes. The `largest` members by the compressed size
+        and the members whose compression saved less than `low_savings` of
+        their size are listed."""
+        if not self.archived:
+            raise BuilderError('The size report needs the EPUB package made by `zipup`.')
+        manifest: _Manifest = self.package_document_spec['manifest']
+        members = {info.name: info for info in self.archived}
+
+        items = []
+        for item in manifest:
+            info = members.get('book/' + item.href)
+            if info is None:
+                continue
+            items.append({
+                'id': item.id,
+                'href': item.href,
+                'media_type': item.media_type,
+                'source_bytes': item.src_path.stat().st_size if item.src_path else None,
+                **_member_sizes(info),
+            })
+
+        by_media_type: dict[str, dict[str, int]] = {}
+        for row in items:
+            _add_sizes(by_media_type.setdefault(row['media_type'], _sizes()), row)
+
+        hrefs = {row['href']: row for row in items}
+        by_spine_item = []
+        for page, group in _spine_groups(spec, manifest).items():
+            total = _sizes()
+            for href in sorted(group):
+                if href in hrefs:
+                    _add_sizes(total, hrefs[href])
+            by_spine_item.append({'href': page, **total})
+
+        rows = [{'name': info.name, **_member_sizes(info)} for info in self.archived]
+        low = [row for row in rows if row['name'] != 'mimetype' and row['stored_bytes'] and
+               row['stored_bytes'] - row['compressed_bytes'] < row['stored_bytes'] * low_savings]
+        total = _sizes()
+        for row in rows:
+            _add_sizes(total, row)
+        zt = self.destdir.parent / (self.packagename + '.epub')
+        return {
+            'package': self.packagename,
+            'items': items,
+            'by_media_type': by_media_type,
+            'by_spine_item': by_spine_item,
+            'largest': sorted(rows, key=lambda row: -row['compressed_bytes'])[:largest],
+            'low_savings': low,
+            'minified': {
+                'count': len(self.minified),
+                'original_bytes': sum(sizes[0] for sizes in self.minified.values()),
+                'minified_bytes': sum(sizes[1] for sizes in self.minified.values()),
+            },
+            'total': {**total, 'archive_bytes': zt.stat().st_size},
+        }
+
+    def build_cached(self, spec: PackageSpec, jobs: int = 1,
+                     cache_size: int = archive.MEMBER_CACHE_SIZE) -> Path:
+        """`build_with` and `zipup` in the reproducible mode. If the package was
+        built from the same inputs, the cached EPUB file is used instead."""
+        if not spec.reproducible:
+            raise BuilderError('The build cache needs the reproducible mode.')
+
+        self.make_package_dirs(spec.curdir)
+        zt = self.destdir.parent / (self.packagename + '.epub')
+        cachedir = self.destdir.parent / _CACHE_DIR_NAME_
+        cached = cachedir / f'{self.packagename}-{_build_cache_key(spec, self.packagename)}.epub'
+        if cached.is_file():
+            self.logger.info(f'using the cached EPUB package\n  -- {str(cached)}')
+            shutil.copyfile(cached, zt)
+            return zt
+
+        self.make_package_document(spec)
+        self.make_navigation_document(spec)
+        self.package_content_items(spec)
+        self.zipup(jobs, cache_size)
+
+        cachedir.mkdir(exist_ok=True)
+        for stale in cachedir.glob(f'{self.packagename}-*.epub'):
+            # not the packages whose names begin with this name and a hyphen
+            if re.fullmatch(f'{re.escape(self.packagename)}-[0-9a-f]{{64}}\\.epub', stale.name):
+                stale.unlink()
+        tmp = cached.with_suffix('.tmp')
+        shutil.copyfile(zt, tmp)
+        tmp.replace(cached)
+        return zt
+
+
+
+# Planning
+
+# rough sizes of the generated documents, for the estimation without rendering
+_ESTIMATED_DOC_SIZE = 500
+_ESTIMATED_ITEM_SIZE = 110
+_ESTIMATED_NAV_POINT_SIZE = 80
+_ESTIMATED_FIGURE_SIZE = 100
+
+def _estimated_page_size(item: _ManifestItem) -> int:
+    size = _ESTIMATED_DOC_SIZE
+    for _, spine_item in item.wrapped or []:
+        size += _ESTIMATED_FIGURE_SIZE + len(spine_item.content_caption.encode('utf-8'))
+        if spine_item.media_type == MediaType.SVG.value:
+            size += Path(spine_item.content_document).stat().st_size
+    return size
+
+def _count_nav_points(points: list[_NavPoint]) -> int:
+    return sum(1 + _count_nav_points(point.children) for point in points)
+
+
+
+# Size report
+
+def _member_sizes(info: archive.MemberInfo) -> dict[str, Any]:
+    return {
+        'stored_bytes': info.file_size,
+        'compressed_bytes': info.compress_size,
+        'ratio': round(info.ratio, 3),
+        'deflated': info.compress_type == archive.DEFLATED,
+    }
+
+def _sizes() -> dict[str, int]:
+    return {'count': 0, 'stored_bytes': 0, 'compressed_bytes': 0}
+
+def _add_sizes(total: dict[str, int], row: dict[str, Any]) -> None:
+    total['count'] += 1
+    total['stored_bytes'] += row['stored_bytes']
+    total['compressed_bytes'] += row['compressed_bytes']
+
+def _spine_groups(spec: PackageSpec, manifest: _Manifest) -> dict[str, set[str]]:
+    """href of each spine item -> hrefs of the item, the images it wraps and
+    the resources they include. A resource shared by several items is in
+    each group."""
+    curdir = spec.curdir.resolve()
+    page_of: dict[str, str] = {}
+    for item in manifest:
+        if item.spine_item_p:
+            page_of[item.href] = item.href
+            for href, _ in item.wrapped or []:
+                page_of[href] = item.href
+
+    groups: dict[str, set[str]] = {}
+    for spine_item in spec.spine:
+        href = 'items/' + str(Path(spine_item.content_document).relative_to(curdir))
+        page = page_of.get(href)
+        if page is None:
+            continue
+        group = groups.setdefault(page, {page})
+        group.add(href)
+        for uri, _ in spine_item.content_includes or []:
+            group.add('items/' + str(Path(uri).relative_to(curdir)))
+    return groups
+
+
+
+# Build cache
+
+_CACHE_DIR_NAME_ = '.cache'
+
+def _build_cache_key(spec: PackageSpec, pkg_name: str) -> str:
+    h = hashlib.sha256()
+    h.update(f'{app.__appname__} {app.__version__}\n{pkg_name}\n{spec.digest()}\n'.encode('utf-8'))
+    # `SOURCE_DATE_EPOCH` changes the modified date without changing the inputs
+    h.update(f'{spec.modified_date.isoformat()}\n'.encode('utf-8'))
+    for path, size, mtime in spec.fingerprints():
+        h.update(f'{path}\t{size}\t{mtime}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+def _member_cache(build_dir: Path, cache_size: int) -> Optional[archive.MemberCache]:
+    if cache_size <= 0:
+        return None
+    return archive.MemberCache(build_dir / _CACHE_DIR_NAME_ / 'members', cache_size)
+
+
+# Appending
+
+_OPS_TYPE = '{http://www.idpf.org/2007/ops}type'
+
+@dataclass
+class _ExistingPackage:
+    opf_name: str
+    nav_name: str
+    metadata: dict[str, Any]
+    manifest: _Manifest
+    page_list: bool = False
+
+def append_package(epub: Path, spec: PackageSpec, jobs: int = 1,
+                   cache_size: int = archive.MEMBER_CACHE_SIZE) -> None:
+    """Adds the spine items of the `spec` to the end of an EPUB package made by
+    tinypublisher. The package document, the navigation document and the
+    new items are written, and the other members are copied without being
+    recompressed. The paths of the `spec` should be relative to the same
+    directory as the package was built from. The new items are compressed
+    through the member cache next to the `epub`."""
+    with ZipFile(epub) as zf:
+        book = _read_package(zf)
+    manifest = book.manifest
+    curdir = spec.curdir.resolve()
+    for spine_item in spec.spine:
+        doc_path = Path(spine_item.content_document)
+        if not doc_path.is_relative_to(curdir):
+            raise BuilderError(f'''All resouces should be in the descendant of the current directory.
+  -- {str(doc_path)}
+  -- curdir: {str(curdir)}''')
+        href = 'items/' + str(doc_path.relative_to(curdir))
+        if href in manifest.by_href or href + '.xhtml' in manifest.by_href:
+            raise BuilderError(f'''The spine item is already in the package.
+  -- {href}''')
+
+    first_item = len(manifest)
+    _make_pkg_doc_items(spec.spine, curdir, spec.images_per_page, manifest)
+    spec.language_tag = book.metadata['language_tag']
+
+    pkg_doc_spec = dict(book.metadata)
+    pkg_doc_spec['modified_date'] = spec.modified_date.isoformat(timespec='seconds') + 'Z'
+    pkg_doc_spec['pkg_items'] = manifest.items
+    pkg_doc_spec['nav_points'] = _nav_points(manifest.items, spec.nav_folders, spec.nav_chunk)
+    pkg_doc_spec['page_list'] = (_page_list(manifest.items) if spec.page_list or book.page_list
+                                 else [])
+    date_time = _zip_date_time(spec.modified_date)
+
+    logger.info(f'appending {len(manifest) - first_item} items to a EPUB package\n  -- {str(epub)}')
+    with tempfile.TemporaryDirectory() as tmp:
+        packager = PackageBuilder(epub.stem)
+        packager.destdir = Path(tmp)
+        for item in manifest.items[first_item:]:
+            packager.package_content_item(spec, item)
+        documents = {}
+        for name, template in [(book.opf_name, 'package.opf'), (book.nav_name, 'navigation.xhtml')]:
+            documents[name] = Path(tmp) / template
+            with open(documents[name], 'w') as f:
+                _render_to(f, template, **pkg_doc_spec)
+
+        appended = epub.with_name(epub.name + '.tmp')
+        try:
+            with open(epub, 'rb') as src, ZipFile(src) as zf, open(appended, 'wb') as f:
+                writer = archive.ArchiveWriter(f)
+                for info in zf.infolist():
+                    if info.filename in documents:
+                        writer.add_file(info.filename, documents[info.filename], date_time=date_time)
+                    else:
+                        writer.add_raw(info, src)
+                base = posixpath.dirname(book.opf_name)
+                items_dir = packager.destdir / 'book'
+                tasks = [archive.Task(posixpath.join(base, p.relative_to(items_dir).as_posix()), p,
+                                      date_time=date_time)
+                         for p in _package_files(items_dir)] if items_dir.is_dir() else []
+                archive.write_files(writer, [task for task in tasks if task.name not in zf.NameToInfo],
+                                    jobs, _member_cache(epub.parent, cache_size))
+                writer.close()
+            appended.replace(epub)
+        except BaseException:
+            appended.unlink(missing_ok=True)
+            raise
+
+def _read_package(zf: ZipFile) -> _ExistingPackage:
+    try:
+        container = ET.fromstring(zf.read('META-INF/container.xml'))
+        rootfile = container.find('.//{*}rootfile')
+        opf_name = rootfile.get('full-path', '') if rootfile is not None else ''
+        opf = ET.fromstring(zf.read(opf_name))
+    except (KeyError, ET.ParseError) as e:
+        raise BuilderError(f'The package document cannot be read: {e}')
+    base = posixpath.dirname(opf_name)
+
+    metadata: dict[str, Any] = {}
+    uid = opf.get('unique-identifier')
+    identifiers = {elm.get('id'): elm.text for elm in opf.findall('{*}metadata/{*}identifier')}
+    # the values are put in the templates as they are, like those of the spec
+    metadata['id'] = _escape(identifiers.get(uid) or next(iter(identifiers.values()), None) or '')
+    metadata['book_title'] = _escape(opf.findtext('{*}metadata/{*}title', ''))
+    metadata['language_tag'] = _escape(opf.findtext('{*}metadata/{*}language', 'und'),
+                                       {'"': '&quot;'})
+    author = opf.findtext('{*}metadata/{*}creator')
+    if author:
+        metadata['author'] = _escape(author)
+
+    spine_ids = [ref.get('idref') for ref in opf.findall('{*}spine/{*}itemref')]
+    spine_idset = set(spine_ids)
+    manifest = _Manifest()
+    nav_href = ''
+    for elm in opf.findall('{*}manifest/{*}item'):
+        properties = (elm.get('properties') or '').split()
+        href = urllib.parse.unquote(elm.get('href', ''))
+        if 'nav' in properties:
+            nav_href = href
+            continue
+        manifest.add_existing(_ManifestItem(
+            id = elm.get('id', ''),
+            href = href,
+            media_type = elm.get('media-type', ''),
+            spine_item_p = elm.get('id') in spine_idset,
+            cover_image_p = 'cover-image' in properties,
+        ))
+    if not nav_href or [item.id for item in manifest if item.spine_item_p] != spine_ids:
+        raise BuilderError(f'The package was not made by {app.__appname__}: {opf_name}')
+
+    nav_name = posixpath.join(base, nav_href)
+    nav = ET.fromstring(zf.read(nav_name))
+    page_list = False
+    for nav_elm in nav.iterfind('.//{*}nav'):
+        if nav_elm.get(_OPS_TYPE) == 'page-list':
+            page_list = True
+        if nav_elm.get(_OPS_TYPE) != 'toc':
+            continue
+        for li in nav_elm.iterfind('.//{*}li'):
+            a = li.find('{*}a')
+            if li.find('{*}ol') is not None or a is None:
+                continue
+            href = posixpath.normpath(posixpath.join(posixpath.dirname(nav_href),
+                                                     urllib.parse.unquote(a.get('href', ''))))
+            item = manifest.by_href.get(href)
+            if item is not None:
+                item.index_title = _escape(''.join(a.itertext()))
+    return _ExistingPackage(opf_name, nav_name, metadata, manifest, page_list)
+
 
 
-            
 # zipup
 
-def _zipwrite(zf: ZipFile, base: Path, *paths: Path) -> None:
-    for p in paths:
+def _zip_date_time(date: datetime.datetime) -> archive.DateTime:
+    if date.year < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    return (date.year, date.month, date.day, date.hour, date.minute, date.second)
+
+def _package_files(base: Path) -> list[Path]:
+    files = []
+    for p in sorted(base.iterdir()):
         if p.is_file():
-            zf.write(p, str(p.relative_to(base)), ZIP_DEFLATED)
+            files.append(p)
         elif p.is_dir():
-            zf.write(p, str(p.relative_to(base)))
-            _zipwrite(zf, base, *p.iterdir())
+            files += _package_files(p)
+    return files
+
+class _ZipWhilePackaging:
+    """Zips the files of the package on a thread in the order they are added,
+    while the builder makes the later ones. The "mimetype" and the documents
+    are added first, and `close` adds the rest of the files in sorted order.
+    The EPUB file is replaced when it is closed."""
+
+    def __init__(self, builder: PackageBuilder) -> None:
+        self.builder = builder
+        self.target = builder.destdir.parent / (builder.packagename + '.epub')
+        self.tmp = self.target.with_name(self.target.name + '.tmp')
+        self.date_time = builder.zip_date_time()
+        self.tasks: queue.SimpleQueue = queue.SimpleQueue()
+        self.added: set[Path] = set()
+        # the members written, which are reported after the packaging
+        self.lock = threading.Lock()
+        self.written: list[archive.MemberInfo] = []
+        self.reporting = False
+        self.thread = ThreadPoolExecutor(1)
+        self.writer = self.thread.submit(self.write)
+        self.add(builder.destdir / 'mimetype', archive.STORED)
+        for name in ['META-INF/container.xml', 'book/package.opf', 'book/navigation.xhtml']:
+            self.add(builder.destdir / name)
+
+    def add(self, path: Path, compress_type: int = archive.DEFLATED) -> None:
+        if path in self.added or not path.is_file():
+            return
+        self.added.add(path)
+        self.tasks.put(archive.Task(str(path.relative_to(self.builder.destdir)), path,
+                                    compress_type, date_time=self.date_time))
+
+    def write(self) -> archive.ArchiveWriter:
+        with open(self.tmp, 'wb') as f:
+            return archive.write_zip(f, iter(self.tasks.get, None), 1, self.on_member,
+                                     _member_cache(self.target.parent, archive.MEMBER_CACHE_SIZE))
+
+    def on_member(self, info: archive.MemberInfo) -> None:
+        with self.lock:
+            self.written.append(info)
+            if self.reporting:
+                self.builder.progress.advance(1, info.file_size)
+
+    def close(self) -> None:
+        for path in _package_files(self.builder.destdir):
+            self.add(path)
+        self.builder.logger.info(f'making a EPUB package\n  -- {str(self.target)}')
+        with self.lock:
+            self.reporting = True
+            self.builder.progress.start('zipping', len(self.added))
+            self.builder.progress.advance(len(self.written),
+                                          sum(info.file_size for info in self.written))
+        self.tasks.put(None)
+        writer = self.writer.result()
+        self.thread.shutdown()
+        self.builder.progress.finish()
+        self.tmp.replace(self.target)
+        self.builder.archived = writer.infolist()
+
+    def abort(self) -> None:
+        self.tasks.put(None)
+        self.writer.exception()
+        self.thread.shutdown()
+        self.tmp.unlink(missing_ok=True)
 
 
             
 # Packaging documents
 
 @dataclass
-class _WrappingDocSpec:
-    language_tag: str
-    title: str
+class _Figure:
     caption: str
     content_src: str
-    css_href: str = ''
     svg: str = ''
 
-def _src_loc(uri: str, curdir: Path) -> str:
-    base = curdir.resolve()
-    dest = Path(uri)
-    while not dest.is_relative_to(base):
-        base = base.parent
-    return str(dest.relative_to(base))
+@dataclass
+class _WrappingDocSpec:
+    language_tag: str
+    title: str
+    figures: list[_Figure]
+    css_href: str = ''
 
-def _wrapping_doc_spec(item_href: str, spec: PackageSpec) -> _WrappingDocSpec:
-    loc = item_href[len('items/'):]
-    loc = loc[:-len('.xhtml')]
-    for spine_item in spec.spine:
-        if _src_loc(spine_item.content_document, spec.curdir) == loc:
-            break
+def _wrapping_doc_spec(item: _ManifestItem, spec: PackageSpec) -> _WrappingDocSpec:
+    assert item.wrapped
+    _, first = item.wrapped[0]
+    page_dir = posixpath.dirname(item.href)
     return _WrappingDocSpec(
         language_tag = spec.language_tag,
-        title = spine_item.index_title if spine_item.index_title else spine_item.content_title,
-        caption = spine_item.content_caption,
-        content_src = loc,
-        svg = spine_item.content_document if spine_item.media_type == MediaType.SVG.value else '',
+        title = first.index_title if first.index_title else first.content_title,
+        figures = [_Figure(
+            caption = spine_item.content_caption,
+            content_src = posixpath.relpath(href, page_dir),
+            svg = spine_item.content_document if spine_item.media_type == MediaType.SVG.value else '',
+        ) for href, spine_item in item.wrapped],
     )
 
-_CSS_HREF = None
 def _css_href(spine: list[SpineItem]) -> str:
-    global _CSS_HREF
-    if _CSS_HREF is None:
-        c = counter()
-        stop = False
-        while not stop:
-            href = f'{app.__appname__}G{next(c)}'
-            stop = True
-            for item in spine:
-                if not item.content_includes:
-                    continue
-                for uri, _ in item.content_includes:
-                    if Path(uri).name == href + '.css':
-                        stop = False
-                        break
-                if not stop:
+    """The name of the style sheet of the wrapping pages, which none of the
+    spine items includes."""
+    c = counter()
+    stop = False
+    while not stop:
+        href = f'{app.__appname__}G{next(c)}'
+        stop = True
+        for item in spine:
+            if not item.content_includes:
+                continue
+            for uri, _ in item.content_includes:
+                if Path(uri).name == href + '.css':
+                    stop = False
                     break
-        _CSS_HREF = href + '.css'
-        c.close()
-    return _CSS_HREF
+            if not stop:
+                break
+    c.close()
+    return href + '.css'
+
+def _stat_origin(path: Union[str, Path]) -> tuple[int, int]:
+    st = Path(path).stat()
+    return (st.st_size, st.st_mtime_ns)
+
+_SVG_PREFIXES = {
+    'http://www.w3.org/2000/svg': '',
+    'http://www.w3.org/1999/xlink': 'xlink',
+    'http://www.w3.org/XML/1998/namespace': 'xml',
+}
 
 def _svg_content(src: str) -> str:
-    ET.register_namespace('', 'http://www.w3.org/2000/svg')
-    ET.register_namespace('xlink', 'http://www.w3.org/1999/xlink')
-    svg = ET.parse(src)
-    svg_content = ET.tostring(svg.getroot(), encoding='unicode')
-    return svg_content.replace('\n', '\n      ')
-    
-def _make_wrapping_doc(spec: PackageSpec, item: _ManifestItem, target: Path) -> None:
-    item_spec = asdict(_wrapping_doc_spec(item.href, spec))
-    css_name = _css_href(spec.spine)
-    item_spec['css_href'] = css_name
-    if item_spec['svg']:
-        item_spec['svg'] = _svg_content(item_spec['svg'])
-    
-    template = _template('page.xhtml')
+    """Serializes the SVG with the prefixes of `_SVG_PREFIXES`. The qualified
+    names are rewritten on this tree, instead of registering the prefixes in
+    ElementTree, which is shared by all threads."""
+    root = ET.parse(src).getroot()
+    prefixes: dict[str, str] = {}
+    def qname(name: str) -> str:
+        if name[:1] != '{':
+            return name
+        uri, local = name[1:].split('}', 1)
+        if uri not in prefixes:
+            prefixes[uri] = _SVG_PREFIXES.get(uri, f'ns{len(prefixes)}')
+        prefix = prefixes[uri]
+        return f'{prefix}:{local}' if prefix else local
 
-    logger.info(f'making a page\n  -- {str(target)}')
-    if not target.parent.is_dir():
-        target.parent.mkdir(parents=True)
-    with open(target, 'w') as f:
-        f.write(template.render(**item_spec))
+    for elem in root.iter():
+        if isinstance(elem.tag, str):
+            elem.tag = qname(elem.tag)
+        attrib = {qname(key): value for key, value in elem.attrib.items()}
+        elem.attrib.clear()
+        elem.attrib.update(attrib)
 
-    css_template = Path(__file__).parent / 'templates/page.css'
-    (target.parent / css_name).write_text(css_template.read_text())
+    declarations = {('xmlns:' + prefix if prefix else 'xmlns'): uri
+                    for uri, prefix in sorted(prefixes.items(), key=lambda x: x[1])
+                    if prefix != 'xml'}
+    root.attrib = {**declarations, **root.attrib}
+    svg_content = ET.tostring(root, encoding='unicode')
+    return svg_content.replace('\n', '\n      ')
+    
+def _make_wrapping_doc(doc_spec: _WrappingDocSpec, fileobj: TextIO) -> None:
+    item_spec = asdict(doc_spec)
+    for figure in item_spec['figures']:
+        if figure['svg']:
+            figure['svg'] = _svg_content(figure['svg'])
+    _render_to(fileobj, 'page.xhtml', **item_spec)
     
 def _copy_item(src_item: _ManifestItem, target: Path) -> None:
     src = src_item.src_path
     if src is None: return
 
-    src_loc = src_item.href[len('items/'):]
-    logger.info(f'copying "{src_loc}" to\n  -- {str(target)}')
-    if not target.parent.is_dir():
-        target.parent.mkdir(parents=True)
+    target.parent.mkdir(parents=True, exist_ok=True)
     if MediaType.predict_text(src_item.media_type):
         target.write_text(src.read_text())
     else:
@@ -215,6 +828,8 @@ class _ManifestItem:
     content_title: Optional[str] = None
     spine_item_p: bool = False
     cover_image_p: bool = False
+    # (href, spine item) of the images embedded in a wrapping doc
+    wrapped: Optional[list[tuple[str, SpineItem]]] = None
     def __hash__(self):
         return hash(self.href)
     def __eq__(self, other):
@@ -239,7 +854,7 @@ def _make_pkg_doc_spec(spec: PackageSpec, pkg_name: str) -> dict[str,str]:
   -- "<build-dir>/{pkg_name}/book/package.opf".''')
     d['language_tag'] = ltag
 
-    d['modified_date'] = datetime.datetime.utcnow().isoformat(timespec='seconds') + 'Z'
+    d['modified_date'] = spec.modified_date.isoformat(timespec='seconds') + 'Z'
 
     return d
 
@@ -249,10 +864,76 @@ def counter() -> Generator:
         yield i+1
         i += 1
         
-def _make_pkg_doc_items(spine: list[SpineItem], curdir: Path) -> list[_ManifestItem]:
-    c = counter()
-    items = set()
+class _Manifest:
+    """The manifest items in insertion order. Ids are assigned in that order,
+    and an item is looked up by its href or by its source file."""
+    def __init__(self) -> None:
+        self.items: list[_ManifestItem] = []
+        self.by_href: dict[str, _ManifestItem] = {}
+        self.last_id = 0
+        self._by_inode: Optional[dict[tuple[int, int], _ManifestItem]] = None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def add(self, item: _ManifestItem) -> _ManifestItem:
+        """Adds the item with the next id. If an item which has the same href
+        is already added, that item is returned instead."""
+        added = self.by_href.get(item.href)
+        if added is not None:
+            return added
+        self.last_id += 1
+        item.id = f'item{self.last_id}'
+        self.items.append(item)
+        self.by_href[item.href] = item
+        if self._by_inode is not None and item.src_path:
+            self._index_inode(item)
+        return item
+
+    def add_existing(self, item: _ManifestItem) -> None:
+        """Adds the item keeping its id. The ids of the items added later are
+        numbered after it."""
+        self.items.append(item)
+        self.by_href[item.href] = item
+        m = re.fullmatch(r'item(\d+)', item.id)
+        if m:
+            self.last_id = max(self.last_id, int(m.group(1)))
+
+    def find_file(self, path: Path, curdir: Path) -> Optional[_ManifestItem]:
+        path = path.resolve()
+        if path.is_relative_to(curdir):
+            item = self.by_href.get('items/' + str(path.relative_to(curdir)))
+            if item is not None and item.src_path:
+                return item
+        # the paths are resolved, so the same file under another name is a
+        # hard link, and only then are the items stated
+        st = path.stat()
+        if st.st_nlink < 2:
+            return None
+        if self._by_inode is None:
+            self._by_inode = {}
+            for item in self.items:
+                if item.src_path:
+                    self._index_inode(item)
+        return self._by_inode.get((st.st_dev, st.st_ino))
+
+    def _index_inode(self, item: _ManifestItem) -> None:
+        assert self._by_inode is not None and item.src_path
+        st = item.src_path.stat()
+        self._by_inode.setdefault((st.st_dev, st.st_ino), item)
+
+def _make_pkg_doc_items(spine: list[SpineItem], curdir: Path, images_per_page: int = 1,
+                        manifest: Optional[_Manifest] = None) -> _Manifest:
+    """The manifest items for the spine. If the `manifest` is given, they are
+    added to it."""
+    if manifest is None:
+        manifest = _Manifest()
+    first_item = len(manifest)
     index_title_count = 0
+    page: Optional[_ManifestItem] = None
     for spine_item in spine:
         doc_path = Path(spine_item.content_document)
         if not doc_path.is_relative_to(curdir):
@@ -260,39 +941,37 @@ def _make_pkg_doc_items(spine: list[SpineItem], curdir: Path) -> list[_ManifestI
   -- {str(doc_path)}
   -- curdir: {str(curdir)}''')
         
-        href = str(doc_path.relative_to(curdir))
+        href = 'items/' + str(doc_path.relative_to(curdir))
         
         if (spine_item.media_type == MediaType.XHTML.value or
             (spine_item.media_type == MediaType.SVG.value and not spine_item.content_caption)):
-            items.add(_ManifestItem(
-                id = f'item{next(c)}',
-                href = 'items/' + href,
+            page = None
+            manifest.add(_ManifestItem(
+                id = '',
+                href = href,
                 index_title = spine_item.index_title,
                 media_type = spine_item.media_type,
                 spine_item_p = True,
-                src_path = Path(spine_item.content_document),
+                src_path = doc_path,
             ))
         else:
             if spine_item.media_type != MediaType.SVG.value:
-                items.add(_ManifestItem(
-                    id = f'item{next(c)}',
-                    href = 'items/' + href,
+                manifest.add(_ManifestItem(
+                    id = '',
+                    href = href,
                     media_type = spine_item.media_type,
-                    src_path = Path(spine_item.content_document),
+                    src_path = doc_path,
                 ))
-            items.add(_wrapping_doc(_ManifestItem(
-                id = f'item{next(c)}',
-                href = 'items/' + href,
-                index_title = spine_item.index_title,
-                content_title = spine_item.content_title,
-                media_type = spine_item.media_type,
-                src_path = Path(spine_item.content_document),
-            ), f'item{next(c)}'))
+            if (page is not None and not spine_item.index_title and
+                (images_per_page <= 0 or len(page.wrapped) < images_per_page)): # type: ignore
+                page.wrapped.append((href, spine_item)) # type: ignore
+            else:
+                page = manifest.add(_wrapping_doc(href, spine_item))
         if spine_item.index_title:
            index_title_count += 1
 
     if not index_title_count:
-        for item in items:
+        for item in manifest.items[first_item:]:
             if not item.spine_item_p:
                 continue
             if item.content_title:
@@ -315,69 +994,136 @@ def _make_pkg_doc_items(spine: list[SpineItem], curdir: Path) -> list[_ManifestI
   -- {str(uri_path)}
   -- curdir: {str(curdir)}''')
 
-            items.add(_ManifestItem(
-                id = f'item{next(c)}',
+            manifest.add(_ManifestItem(
+                id = '',
                 href = 'items/' + str(uri_path.relative_to(curdir)),
                 media_type = mime,
-                src_path = Path(uri),
+                src_path = uri_path,
             ))
-    c.close()
-    return sorted(items, key=lambda itm: int(itm.id[4:]))
+    return manifest
 
-def _wrapping_doc(item: _ManifestItem, id: str) -> _ManifestItem:
+def _wrapping_doc(href: str, spine_item: SpineItem) -> _ManifestItem:
     return _ManifestItem(
-        id = id,
-        href = item.href + '.xhtml',
-        index_title = item.index_title,
-        content_title = item.content_title,
+        id = '',
+        href = href + '.xhtml',
+        index_title = spine_item.index_title,
+        content_title = spine_item.content_title,
         media_type = MediaType.XHTML.value,
         spine_item_p = True,
+        wrapped = [(href, spine_item)],
     )
 
-def _pkg_doc_add_cover_image(img_path: Path, manifest: dict[str, Any], curdir: Path) -> None:
-    find = False
-    for item in manifest['pkg_items']:
-        if item.src_path and item.src_path.samefile(img_path):
-            item.cover_image_p = True
-            find = True
-            break
-    if not find:
-        if not img_path.is_relative_to(curdir):
-            raise BuilderError(f'''All resouces should be in the descendant of the current directory.
+def _pkg_doc_add_cover_image(img_path: Path, manifest: _Manifest, curdir: Path) -> None:
+    item = manifest.find_file(img_path, curdir.resolve())
+    if item is not None:
+        item.cover_image_p = True
+        return
+
+    if not img_path.is_relative_to(curdir):
+        raise BuilderError(f'''All resouces should be in the descendant of the current directory.
   -- {str(img_path)}
   -- curdir: {curdir}''')
-        
-        manifest['pkg_items'].append(_ManifestItem(
-            id = _next_id(manifest['pkg_items'][-1]),
-            href = 'items/' + str(img_path.relative_to(curdir)),
-            media_type = magic.from_file(str(img_path), mime=True),
-            src_path = img_path,
-            cover_image_p = True,
-        ))
 
-def _next_id(item: _ManifestItem) -> str:
-    return f'item{str(int(item.id[4:])+1)}'
+    manifest.add(_ManifestItem(
+        id = '',
+        href = 'items/' + str(img_path.relative_to(curdir)),
+        media_type = magic.from_file(str(img_path), mime=True),
+        src_path = img_path,
+        cover_image_p = True,
+    ))
+
+
+
+# Navigation document
+
+@dataclass
+class _NavPoint:
+    title: str
+    href: str
+    children: list[_NavPoint] = field(default_factory=list)
+
+def _nav_points(items: list[_ManifestItem], folders: bool = False,
+                chunk: int = 0) -> list[_NavPoint]:
+    """The entries of the table of contents. If `folders`, they are nested by
+    the directories of the items. If `chunk` > 0, every list of the entries
+    longer than that is divided into groups of `chunk` entries."""
+    if chunk == 1:
+        raise BuilderError('The entries of the table of contents cannot be grouped by 1.')
+    points = [(item.href, _NavPoint(item.index_title, item.href))
+              for item in items if item.spine_item_p and item.index_title]
+    if folders:
+        tree = _nav_folders(points)
+    else:
+        tree = [point for _, point in points]
+    return _nav_chunks(tree, chunk) if chunk > 0 else tree
+
+def _nav_folders(points: list[tuple[str, _NavPoint]]) -> list[_NavPoint]:
+    root: list[_NavPoint] = []
+    folders: dict[str, _NavPoint] = {}
+    for href, point in points:
+        siblings = root
+        loc = ''
+        for name in PurePosixPath(href).parent.parts[1:]:
+            loc += '/' + name
+            folder = folders.get(loc)
+            if folder is None:
+                folder = folders[loc] = _NavPoint(name, point.href)
+                siblings.append(folder)
+            siblings = folder.children
+        siblings.append(point)
+    return root
+
+def _nav_chunks(points: list[_NavPoint], chunk: int) -> list[_NavPoint]:
+    for point in points:
+        if point.children:
+            point.children = _nav_chunks(point.children, chunk)
+    # (point, the titles of its first and last entries)
+    ranges = [(point, point.title, point.title) for point in points]
+    while len(ranges) > chunk:
+        groups = [ranges[i:i+chunk] for i in range(0, len(ranges), chunk)]
+        ranges = [_nav_chunk(group) if len(group) > 1 else group[0] for group in groups]
+    return [point for point, _, _ in ranges]
+
+def _nav_chunk(group: list[tuple[_NavPoint, str, str]]) -> tuple[_NavPoint, str, str]:
+    first, last = group[0][1], group[-1][2]
+    point = _NavPoint(f'{first} – {last}', group[0][0].href, [point for point, _, _ in group])
+    return point, first, last
+
+def _page_list(items: list[_ManifestItem]) -> list[_NavPoint]:
+    spine_items = (item for item in items if item.spine_item_p)
+    return [_NavPoint(str(i), item.href) for i, item in enumerate(spine_items, 1)]
 
 
 
 # Package directory utils
 
+@lru_cache(maxsize=None)
 def _template(name: str) -> Template:
     filename = str(Path(__file__).parent / 'templates' / name)
     return Template(filename=filename)
+
+def _render_to(fileobj: TextIO, name: str, **data: Any) -> None:
+    """Renders the template into the `fileobj` piece by piece, so the whole
+    document is never held in memory. The output is the same as `render`."""
+    _template(name).render_context(Context(fileobj, **data))
     
+# a build dir and its dotfile are made together, not to be taken for a
+# foreign dir by another build
+_build_dir_lock = threading.Lock()
+
 def _make_build_dir(stem: Path, *candidates: str) -> Path: # failable
     assert len(candidates) > 0
     
     dest = stem / candidates[0]
     dotfile = dest / ('.' + app.__appname__)
-    if not dest.exists():
-        logger.info(f'making a build dir\n  -- {str(dest)}')
-        dest.mkdir()
-        dotfile.touch()
-        return dest
-    if dotfile.exists():
-        return dest
+    with _build_dir_lock:
+        if not dest.exists():
+            logger.info(f'making a build dir\n  -- {str(dest)}')
+            dest.mkdir(exist_ok=True)
+            dotfile.touch()
+            return dest
+        if dotfile.exists():
+            return dest
     if len(candidates) > 1:
         return _make_build_dir(stem, *candidates[1:])
 
@@ -386,8 +1132,7 @@ def _make_build_dir(stem: Path, *candidates: str) -> Path: # failable
 
 def _make_container_file(path: Path, pkg_doc: Path) -> None:
     pkg_doc_loc = str(pkg_doc.relative_to(path.parent.parent))
-    template = _template(path.name)
     with open(path, 'w') as f:
-        f.write(template.render(pkg_doc_loc=pkg_doc_loc))
+        _render_to(f, path.name, pkg_doc_loc=pkg_doc_loc)
         
     
@@ -1,7 +1,11 @@
-import sys, argparse, pathlib
+import sys, os, argparse, pathlib, json, logging, contextlib
 
+import tinypublisher as app
 import tinypublisher.reader as reader
 import tinypublisher.builder as builder
+import tinypublisher.watcher as watcher
+import tinypublisher.server as server
+import tinypublisher.progress as progress
 
 
 _FILE_LIST_DESCRIPTION_ = """\
@@ -38,6 +42,70 @@ def _argparser():
     
     parser.add_argument('--unzipped', action='store_true', help='make the package unzipped')
     parser.add_argument('packagename', metavar='package-name', help='EPUB Package directory and make the file <package-name>.epub')
+    _add_package_arguments(parser)
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and rebuild the package whenever the file list or its resources are modified (needs `--spine`, not used with `--plan`, `--size-report` or `--cache`)')
+    parser.add_argument('-s', '--spine', metavar='file-list', type=pathlib.Path,
+                        help='a tab-separated-values file that each line is the spine element for the package. you can also read this list from the standard input')
+    parser.add_argument('--from-dir', metavar='dir', type=pathlib.Path,
+                        help='use the files under this directory for the spine elements instead of a file list, in the natural order of their paths')
+    parser.add_argument('--include', metavar='glob', action='append', default=[],
+                        help='with `--from-dir`, use only the files that match this pattern (can be repeated). if not, image, XHTML and SVG files are used')
+    parser.add_argument('--exclude', metavar='glob', action='append', default=[],
+                        help='with `--from-dir`, skip the files that match this pattern (can be repeated)')
+    parser.add_argument('--titles-from-names', action='store_true',
+                        help='with `--from-dir`, use the file names for the index titles')
+    _add_limit_arguments(parser)
+    return parser
+
+def _add_limit_arguments(parser):
+    limits = reader.InspectionLimits()
+    parser.add_argument('--max-file-size', metavar='MiB', type=_positive(int), default=limits.max_bytes // (1024 * 1024),
+                        help=f'reject a XHTML, SVG or CSS file larger than this (default: {limits.max_bytes // (1024 * 1024)})')
+    parser.add_argument('--max-elements', metavar='N', type=_positive(int), default=limits.max_elements,
+                        help=f'reject a XHTML or SVG file which has more elements than this (default: {limits.max_elements})')
+    parser.add_argument('--max-depth', metavar='N', type=_positive(int), default=limits.max_depth,
+                        help=f'reject a XHTML or SVG file which nests elements deeper than this (default: {limits.max_depth})')
+    parser.add_argument('--max-inspection-time', metavar='seconds', type=_positive(float), default=limits.max_seconds,
+                        help=f'reject an entry of the file list which takes longer than this to inspect with its linked files (default: {limits.max_seconds:g})')
+
+def _positive(type_):
+    def positive(value):
+        n = type_(value)
+        if not n > 0:
+            raise argparse.ArgumentTypeError('should be more than 0')
+        return n
+    # argparse names the type by this in the errors
+    positive.__name__ = type_.__name__
+    return positive
+
+def _limits(args):
+    return reader.InspectionLimits(args.max_file_size * 1024 * 1024, args.max_elements,
+                                   args.max_depth, args.max_inspection_time)
+
+def _nav_chunk(value):
+    n = int(value)
+    if n < 0 or n == 1:
+        raise argparse.ArgumentTypeError('should be 0 or more than 1')
+    return n
+
+def _add_layout_arguments(parser):
+    parser.add_argument('--images-per-page', metavar='N', type=int, default=1,
+                        help='wrap N consecutive images in a page. if 0, the images up to the next entry which has an index title are wrapped in a page (default: 1)')
+    parser.add_argument('--nav-folders', action='store_true',
+                        help='nest the table of contents by the directories of the spine elements')
+    parser.add_argument('--nav-chunk', metavar='N', type=_nav_chunk, default=0,
+                        help='group every N entries of the table of contents, so that no list of it is longer than N')
+    parser.add_argument('--page-list', action='store_true',
+                        help='add a page-list navigation that links to every spine element')
+
+def _add_zip_arguments(parser):
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='compress the package members on N processes. if 0, the number of CPUs is used (default: 1)')
+    parser.add_argument('--member-cache', metavar='MiB', type=int, default=256,
+                        help='reuse the compressed members of the same contents from `.cache/members` next to the EPUB file, which keeps up to this size of the recently used ones for any package. if 0, the cache is not used (default: 256)')
+
+def _add_package_arguments(parser):
     parser.add_argument('-c', '--cover', metavar='cover-image',
                         help='used for <item properties="cover-image" href="<cover-image>"/>')
     parser.add_argument('-t', '--title', metavar='title',
@@ -49,15 +117,143 @@ def _argparser():
     parser.add_argument('--id', metavar='identifier',
                         help='used for <dc:identifier> element of the package document')
     parser.add_argument('--uuid', metavar='dns-name', help='if the <identifier> is not specified, use this value for generate the package unique identifier with `uuid5(NAMESPACE_DNS, <dns-name>)`. if both are not specified, generated by `uuid4()`')
+    _add_layout_arguments(parser)
+    parser.add_argument('--minify', action='store_true',
+                        help='strip the comments and the insignificant whitespace of the XHTML, SVG and CSS files in the package. the text of <pre>, the elements with `xml:space="preserve"` and the CSS strings are kept')
+    _add_zip_arguments(parser)
+    parser.add_argument('--reproducible', action='store_true',
+                        help='make the same package from the same inputs. the modified date is `$SOURCE_DATE_EPOCH` or the latest modification time of the inputs, and the unique identifier is generated from the inputs if neither `--id` nor `--uuid` is specified')
+    parser.add_argument('--cache', action='store_true',
+                        help='reuse the package built from the same inputs before (implies `--reproducible`, not used with `--unzipped`)')
+    parser.add_argument('--plan', metavar='format', nargs='?', const='text', choices=['text', 'json'],
+                        help='only show the manifest, the spine, the table of contents, the wrapping pages and the estimated size of the package, without writing any files. the format is `text` (default) or `json`')
+    parser.add_argument('--size-report', metavar='format', nargs='?', const='text', choices=['text', 'json'],
+                        help='show the sizes of the items in the EPUB file by the media type and by the spine element, the largest ones and the ones hardly compressed. the format is `text` (default) or `json`. the package is made even if `--cache` is specified')
+    _add_verbosity_arguments(parser)
+    parser.add_argument('--events', metavar='file',
+                        help='write the progress as JSON lines of the events `start`, `progress` and `finish` to this file. if `-`, to the standard output (not used with `--plan` or `--size-report`)')
+
+def _add_verbosity_arguments(parser):
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='show only the warnings and the errors, without the progress bar')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log every item packaged instead of showing the progress bar')
+
+def _compile_argparser():
+    parser = argparse.ArgumentParser(
+        prog='tinypublish-compile',
+        description='Save the file list and the inspections of its files, so that `tinypublish-build` makes packages from them without inspecting the unmodified files again.',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=_FILE_LIST_DESCRIPTION_)
+
     parser.add_argument('-s', '--spine', metavar='file-list', type=pathlib.Path,
-                        help='a tab-separated-values file that each line is the spine element for the package. you can also read this list from the standard input')
+                        help='a file list of the spine elements. you can also read this list from the standard input')
+    parser.add_argument('-o', '--output', metavar='book.spec', type=pathlib.Path, required=True,
+                        help='the snapshot file to be written')
+    _add_verbosity_arguments(parser)
+    _add_limit_arguments(parser)
     return parser
 
-def main():
-    argparser = _argparser()
+def compile_spec(argv):
+    argparser = _compile_argparser()
+    args = argparser.parse_args(argv)
+    _set_verbosity(args)
     try:
-        args = argparser.parse_args()
-        file_list_parser = reader.FileListParser()
+        file_list_parser = reader.FileListParser(limits=_limits(args))
+        if args.spine and not args.spine.is_file():
+            raise Exception(f'"{str(args.spine)}" should be a regular file.')
+        tmp = args.output.with_name(args.output.name + '.tmp')
+        try:
+            with open(tmp, 'wb') as out:
+                if args.spine:
+                    file_list_parser.curdir = args.spine.parent
+                    with open(args.spine) as f:
+                        file_list_parser.compile(f, out)
+                else:
+                    file_list_parser.compile(sys.stdin, out)
+            tmp.replace(args.output)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+    except app.AppBaseError as e:
+        print(e)
+
+    except Exception as e:
+        print(e)
+        argparser.print_help()
+
+def _build_argparser():
+    parser = argparse.ArgumentParser(
+        prog='tinypublish-build',
+        description='Build a EPUB package from a snapshot saved by `tinypublish-compile`. The files modified since are inspected again.')
+
+    parser.add_argument('--unzipped', action='store_true', help='make the package unzipped')
+    parser.add_argument('spec', metavar='book.spec', type=pathlib.Path,
+                        help='the snapshot of the file list')
+    parser.add_argument('packagename', metavar='package-name', nargs='?',
+                        help='EPUB Package directory and make the file <package-name>.epub. if not, the name of the snapshot is used')
+    _add_package_arguments(parser)
+    _add_limit_arguments(parser)
+    return parser
+
+def build_spec(argv):
+    argparser = _build_argparser()
+    try:
+        args = argparser.parse_args(argv)
+        _set_verbosity(args)
+        if not args.spec.is_file():
+            raise Exception(f'"{str(args.spec)}" should be a regular file.')
+        if args.packagename is None:
+            args.packagename = args.spec.stem
+
+        collector = _collect_warnings() if args.plan else None
+        with open(args.spec, 'rb') as f:
+            package_spec = reader.load_snapshot(f, _limits(args))
+        _configure(package_spec, args)
+        _make_package(package_spec, args, collector)
+
+    except app.AppBaseError as e:
+        print(e)
+
+    except Exception as e:
+        print(e)
+        argparser.print_help()
+
+def _append_argparser():
+    parser = argparse.ArgumentParser(
+        prog='tinypublish-append',
+        description='Add spine elements to the end of a EPUB package made by tinypublish.',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=_FILE_LIST_DESCRIPTION_)
+
+    parser.add_argument('epub', metavar='book.epub', type=pathlib.Path,
+                        help='the EPUB package to be updated')
+    parser.add_argument('-s', '--spine', metavar='file-list', type=pathlib.Path,
+                        help='a file list of the spine elements to be added. its paths should be relative to the same directory as the package was built from. you can also read this list from the standard input')
+    _add_layout_arguments(parser)
+    _add_zip_arguments(parser)
+    _add_verbosity_arguments(parser)
+    _add_limit_arguments(parser)
+    return parser
+
+def _setup_logger(level=logging.INFO):
+    logger = logging.getLogger(app.__appname__)
+    logger.setLevel(level)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(name)s.%(levelname)s: %(message)s'))
+        logger.addHandler(handler)
+
+def append(argv):
+    argparser = _append_argparser()
+    try:
+        args = argparser.parse_args(argv)
+        _set_verbosity(args)
+        if not args.epub.is_file():
+            raise Exception(f'"{str(args.epub)}" should be a regular file.')
+
+        file_list_parser = reader.FileListParser(limits=_limits(args))
         if args.spine:
             if not args.spine.is_file():
                 raise Exception(f'"{str(args.spine)}" should be a regular file.')
@@ -66,20 +262,241 @@ def main():
                 package_spec = file_list_parser.parse(f)
         else:
             package_spec = file_list_parser.parse(sys.stdin)
-        
-        package_spec.cover_image = args.cover
-        package_spec.book_title = args.title if args.title is not None else args.packagename
-        if args.author:
-            package_spec.author = args.author
-        package_spec.language_tag = args.language
-        package_spec.id = args.id if args.id is not None else None
-        package_spec.uuid = args.uuid
-
-        packager = builder.PackageBuilder(args.packagename)
-        packager.build_with(package_spec)
-
-        if not args.unzipped:
-            packager.zipup()
+        package_spec.images_per_page = args.images_per_page
+        package_spec.nav_folders = args.nav_folders
+        package_spec.nav_chunk = args.nav_chunk
+        package_spec.page_list = args.page_list
+
+        jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+        builder.append_package(args.epub, package_spec, jobs, args.member_cache * 1024 * 1024)
+
+    except app.AppBaseError as e:
+        print(e)
+
+    except Exception as e:
+        print(e)
+        argparser.print_help()
+
+def _serve_argparser():
+    parser = argparse.ArgumentParser(
+        prog='tinypublish-serve',
+        description='Run a local HTTP server which builds EPUB packages on a pool of worker processes. `POST /build?name=<package-name>` with a file list (its paths are relative to the dir given by the `dir` parameter, under the root) or a zip of the sources which has "spine.tsv", and the EPUB package is sent back. The other parameters are `title`, `author`, `language`, `id`, `uuid`, `cover`, `images-per-page`, `nav-folders`, `nav-chunk`, `page-list`, `minify` and `reproducible`.')
+
+    parser.add_argument('--host', metavar='host', default='127.0.0.1',
+                        help='the address to listen on (default: 127.0.0.1)')
+    parser.add_argument('-p', '--port', metavar='port', type=int, default=8000,
+                        help='the port to listen on (default: 8000)')
+    parser.add_argument('-w', '--workers', metavar='N', type=int, default=0,
+                        help='the number of worker processes. if 0, the number of CPUs is used (default: 0)')
+    parser.add_argument('--root', metavar='dir', type=pathlib.Path, default=pathlib.Path('.'),
+                        help='the file lists are resolved under this dir (default: the current dir)')
+    _add_verbosity_arguments(parser)
+    _add_limit_arguments(parser)
+    return parser
+
+def serve(argv):
+    argparser = _serve_argparser()
+    args = argparser.parse_args(argv)
+    _set_verbosity(args)
+    if not args.root.is_dir():
+        print(f'"{str(args.root)}" should be a directory.')
+        return
+    workers = args.workers if args.workers > 0 else os.cpu_count() or 1
+    server.serve(args.root, args.host, args.port, workers, _limits(args))
+
+def _configure(package_spec, args):
+    package_spec.cover_image = args.cover
+    package_spec.book_title = args.title if args.title is not None else args.packagename
+    if args.author:
+        package_spec.author = args.author
+    package_spec.language_tag = args.language
+    package_spec.id = args.id if args.id is not None else None
+    package_spec.uuid = args.uuid
+    package_spec.reproducible = args.reproducible or args.cache
+    package_spec.images_per_page = args.images_per_page
+    package_spec.nav_folders = args.nav_folders
+    package_spec.nav_chunk = args.nav_chunk
+    package_spec.page_list = args.page_list
+    package_spec.minify = args.minify
+
+class _WarningCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def _print_plan(plan, fmt):
+    if fmt == 'json':
+        json.dump(plan, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+        return
+
+    print(f'manifest ({len(plan["manifest"])} items):')
+    for item in plan['manifest']:
+        props = f' [{item["properties"]}]' if item['properties'] else ''
+        print(f'  {item["id"]}\t{item["media_type"]}\t{item["href"]}{props}')
+    print(f'spine ({len(plan["spine"])} items): {" ".join(plan["spine"])}')
+    print('nav:')
+    def print_points(points, indent):
+        for point in points:
+            print(f'{indent}{point["title"]} -> {point["href"]}')
+            print_points(point['children'], indent + '  ')
+    print_points(plan['nav'], '  ')
+    if plan['page_list']:
+        print(f'page-list: {plan["page_list"]} pages')
+    print(f'wrapping pages ({len(plan["wrapping_pages"])}):')
+    for page in plan['wrapping_pages']:
+        print(f'  {page["href"]} <- {", ".join(page["figures"])}')
+    print(f'estimated size: {plan["estimated_bytes"]} bytes (before compression)')
+    if plan['warnings']:
+        print('warnings:')
+        for message in plan['warnings']:
+            print('  ' + message.replace('\n', '\n  '))
+
+def _print_size_report(report, fmt):
+    if fmt == 'json':
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+        return
+
+    def sizes(row):
+        return f'{row["stored_bytes"]:>10} {row["compressed_bytes"]:>10}'
+    print(f'{"":40} {"stored":>10} {"compressed":>10} {"source":>10}  ratio')
+    for item in report['items']:
+        source = item['source_bytes'] if item['source_bytes'] is not None else '-'
+        print(f'{item["href"]:40} {sizes(item)} {source:>10}  {item["ratio"]:.3f}')
+    print('by media type:')
+    for media_type, total in report['by_media_type'].items():
+        print(f'  {media_type:38} {sizes(total)}  ({total["count"]} items)')
+    print('by spine element:')
+    for group in report['by_spine_item']:
+        print(f'  {group["href"]:38} {sizes(group)}  ({group["count"]} items)')
+    print('largest:')
+    for row in report['largest']:
+        print(f'  {row["name"]:38} {sizes(row)}')
+    if report['low_savings']:
+        print('hardly compressed:')
+        for row in report['low_savings']:
+            how = 'deflated' if row['deflated'] else 'stored'
+            print(f'  {row["name"]:38} {sizes(row)}  {how}')
+    minified = report['minified']
+    if minified['count']:
+        print(f'minified: {minified["count"]} documents, {minified["original_bytes"]} -> '
+              f'{minified["minified_bytes"]} bytes')
+    total = report['total']
+    print(f'total: {total["count"]} members, {total["stored_bytes"]} bytes stored, '
+          f'{total["compressed_bytes"]} bytes compressed, {total["archive_bytes"]} bytes of the EPUB file')
+
+def _set_verbosity(args):
+    if args.quiet:
+        logging.getLogger(app.__appname__).setLevel(logging.WARNING)
+    elif args.verbose:
+        logging.getLogger(app.__appname__).setLevel(logging.DEBUG)
+
+@contextlib.contextmanager
+def _progress(args):
+    progresses = []
+    if not args.quiet and not args.verbose:
+        progresses.append(progress.ProgressBar(sys.stderr))
+    with contextlib.ExitStack() as stack:
+        if args.events == '-':
+            progresses.append(progress.EventStream(sys.stdout))
+        elif args.events:
+            progresses.append(progress.EventStream(stack.enter_context(open(args.events, 'w'))))
+        yield progress.ProgressGroup(*progresses)
+
+def _collect_warnings():
+    collector = _WarningCollector()
+    logging.getLogger(app.__appname__).addHandler(collector)
+    return collector
+
+def _make_package(package_spec, args, collector=None):
+    if args.events == '-' and (args.plan or args.size_report):
+        raise Exception('`--events -` is not used with `--plan` or `--size-report`, which write to the standard output.')
+    with _progress(args) as reporter:
+        _make_package_with(package_spec, args, reporter, collector)
+
+def _make_package_with(package_spec, args, reporter, collector=None):
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+    cache_size = args.member_cache * 1024 * 1024
+    packager = builder.PackageBuilder(args.packagename, reporter)
+    if args.plan:
+        plan = packager.plan(package_spec)
+        plan['warnings'] = collector.messages if collector else []
+        _print_plan(plan, args.plan)
+        return
+    if args.size_report and args.unzipped:
+        raise Exception('`--size-report` is not used with `--unzipped`.')
+    if args.cache and not args.unzipped and not args.size_report:
+        packager.build_cached(package_spec, jobs, cache_size)
+        return
+    packager.build_with(package_spec)
+
+    if not args.unzipped:
+        packager.zipup(jobs, cache_size)
+    if args.size_report:
+        _print_size_report(packager.size_report(package_spec), args.size_report)
+
+# the commands other than `tinypublish` have their own entry points, since
+# any word may be a package name
+
+def append_main():
+    _setup_logger()
+    append(sys.argv[1:])
+
+def compile_main():
+    _setup_logger()
+    compile_spec(sys.argv[1:])
+
+def build_main():
+    _setup_logger()
+    build_spec(sys.argv[1:])
+
+def serve_main():
+    _setup_logger()
+    serve(sys.argv[1:])
+
+def main():
+    _setup_logger()
+    argparser = _argparser()
+    try:
+        args = argparser.parse_args()
+        _set_verbosity(args)
+        if args.spine and not args.spine.is_file():
+            raise Exception(f'"{str(args.spine)}" should be a regular file.')
+
+        if args.watch:
+            if not args.spine:
+                raise Exception('`--watch` needs a file list specified by `--spine`.')
+            if args.plan or args.size_report or args.cache:
+                raise Exception('`--plan`, `--size-report` and `--cache` are not used with `--watch`.')
+            jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+            with _progress(args) as reporter:
+                watcher.Watcher(args.spine, args.packagename,
+                                configure=lambda spec: _configure(spec, args),
+                                zipped=not args.unzipped, limits=_limits(args), jobs=jobs,
+                                cache_size=args.member_cache * 1024 * 1024,
+                                progress=reporter).run()
+            return
+
+        collector = _collect_warnings() if args.plan else None
+        file_list_parser = reader.FileListParser(limits=_limits(args))
+        if args.from_dir:
+            if not args.from_dir.is_dir():
+                raise Exception(f'"{str(args.from_dir)}" should be a directory.')
+            file_list_parser.curdir = args.from_dir
+            package_spec = file_list_parser.parse_dir(args.include, args.exclude,
+                                                      args.titles_from_names)
+        elif args.spine:
+            file_list_parser.curdir = args.spine.parent
+            with open(args.spine) as f:
+                package_spec = file_list_parser.parse(f)
+        else:
+            package_spec = file_list_parser.parse(sys.stdin)
+        _configure(package_spec, args)
+        _make_package(package_spec, args, collector)
 
     except app.AppBaseError as e:
         print(e)
@@ -0,0 +1,248 @@
+from __future__ import annotations
+from pathlib import Path
+from typing import Optional, TextIO
+import codecs, re, shutil
+
+import tinypublisher as app
+from tinypublisher.package import MediaType
+
+import logging
+logger = logging.getLogger(f'{app.__appname__}.minify')
+
+
+_CHUNK_SIZE = 64 * 1024
+
+class Minifier:
+    """Minifies a document fed chunk by chunk. A token which may continue in
+    the next chunk is held until it is complete."""
+    _token: re.Pattern
+
+    def __init__(self) -> None:
+        self.buffer = ''
+
+    def feed(self, chunk: str) -> str:
+        self.buffer += chunk
+        return self._flush(final=False)
+
+    def close(self) -> str:
+        return self._flush(final=True)
+
+    def _flush(self, final: bool) -> str:
+        out = []
+        pos = 0
+        while pos < len(self.buffer):
+            m = self._token.match(self.buffer, pos)
+            if m is None or not self._complete(m.group()):
+                break
+            if m.end() == len(self.buffer) and not final:
+                break
+            out.append(self.token(m.group()))
+            pos = m.end()
+        self.buffer = self.buffer[pos:]
+        if final:
+            out.append(self.buffer)
+            self.buffer = ''
+        return ''.join(out)
+
+    def _complete(self, token: str) -> bool:
+        return True
+
+    def token(self, token: str) -> str:
+        raise NotImplementedError
+
+
+# XHTML and SVG
+
+_XML_SPACE = '[ \t\r\n]+'
+_XML_TOKEN = re.compile(r'''
+    <!--.*?-->
+  | <!\[CDATA\[.*?\]\]>
+  | <\?.*?\?>
+  | <!(?!--|\[CDATA\[)(?:[^>"'\[]|"[^"]*"|'[^']*'|\[[^\]]*\])*>
+  | <[^!?](?:[^>"']|"[^"]*"|'[^']*')*>
+  | [^<]+
+  | <
+''', re.S | re.X)
+_XML_QUOTED = re.compile(r'''("[^"]*"|'[^']*')''')
+_XML_NAME = re.compile(r'</?([^ \t\r\n/>]+)')
+_XML_SPACE_ATTR = re.compile(r'''xml:space[ \t\r\n]*=[ \t\r\n]*["'](\w+)["']''')
+
+# the elements whose text is kept as is
+_PRESERVED = {'pre', 'textarea', 'script', 'style'}
+# the elements in which the whitespace between the children is insignificant
+_ELEMENT_ONLY = {
+    'html', 'head', 'ol', 'ul', 'dl', 'table', 'thead', 'tbody', 'tfoot', 'tr',
+    'colgroup', 'select', 'optgroup',
+    'svg', 'g', 'defs', 'symbol', 'clipPath', 'mask', 'pattern', 'marker',
+    'linearGradient', 'radialGradient', 'filter', 'switch',
+}
+
+class XMLMinifier(Minifier):
+    """Removes the comments and the whitespace between the markups, and
+    collapses the whitespace in the text into a space or a newline. The text
+    of `pre`, `textarea`, `script` and `style`, and of the elements with
+    `xml:space="preserve"` is kept, and the markups are kept except the
+    whitespace between the attributes."""
+    _token = _XML_TOKEN
+
+    def __init__(self) -> None:
+        super().__init__()
+        # (local name, whether the whitespace is preserved) of the open elements
+        self.stack: list[tuple[str, bool]] = []
+
+    def _complete(self, token: str) -> bool:
+        return token != '<'
+
+    def token(self, token: str) -> str:
+        if token.startswith('<!--'):
+            return ''
+        if token.startswith(('<![CDATA[', '<?', '<!')):
+            return token
+        if token.startswith('</'):
+            if self.stack:
+                self.stack.pop()
+            return _tag(token)
+        if token.startswith('<'):
+            self.start_tag(token)
+            return _tag(token)
+        return self.text(token)
+
+    def start_tag(self, token: str) -> None:
+        if token.endswith('/>'):
+            return
+        m = _XML_NAME.match(token)
+        name = m.group(1).split(':')[-1] if m else ''
+        preserved = self.stack[-1][1] if self.stack else False
+        space = _XML_SPACE_ATTR.search(token)
+        if space:
+            preserved = space.group(1) == 'preserve'
+        self.stack.append((name, preserved or name in _PRESERVED))
+
+    def text(self, text: str) -> str:
+        if self.stack and self.stack[-1][1]:
+            return text
+        if not text.strip(' \t\r\n') and (not self.stack or self.stack[-1][0] in _ELEMENT_ONLY):
+            return ''
+        return re.sub(_XML_SPACE, lambda m: '\n' if '\n' in m.group() else ' ', text)
+
+def _tag(token: str) -> str:
+    parts = _XML_QUOTED.split(token)
+    for i in range(0, len(parts), 2):
+        part = re.sub(_XML_SPACE, ' ', parts[i])
+        parts[i] = re.sub(' ?= ?', '=', part)
+    return re.sub(' (/?>)$', r'\1', ''.join(parts))
+
+
+# CSS
+
+_CSS_SPACE = ' \t\r\n\f'
+_CSS_TOKEN = re.compile(r'''
+    /\*.*?\*/
+  | "(?:[^"\\\n]|\\.)*(?:"|(?=\n))
+  | '(?:[^'\\\n]|\\.)*(?:'|(?=\n))
+  | [ \t\r\n\f]+
+  | [^"'/ \t\r\n\f]+
+  | /(?!\*)
+''', re.S | re.X)
+_CSS_STRING = re.compile(r'"(?:[^"\\\n]|\\.)*"' r"|'(?:[^'\\\n]|\\.)*'", re.S)
+# the whitespace next to these is removed
+_CSS_PUNCTUATION = '{};,'
+
+class CSSMinifier(Minifier):
+    """Removes the comments except "/*! ... */", the whitespace next to the
+    braces, the semicolons and the commas, and the whitespace after the
+    colons, which never changes a selector ("a :hover" is not "a:hover"). The
+    other whitespace is collapsed into a space, and the string literals are
+    kept. A string left open ends at the newline, as in the CSS syntax, so
+    the newline is kept after it."""
+    _token = _CSS_TOKEN
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.last = ''
+        self.space = False
+        self.open_string = False
+
+    def token(self, token: str) -> str:
+        if token[0] in _CSS_SPACE:
+            if self.open_string:
+                self.open_string = False
+                self.last = '\n'
+                return '\n'
+            self.space = True
+            return ''
+        if token.startswith('/*'):
+            # a kept comment leaves the whitespace around it pending
+            return token if token.startswith('/*!') else ''
+        out = ''
+        if (self.space and self.last and self.last not in _CSS_PUNCTUATION + ':' and
+            token[0] not in _CSS_PUNCTUATION):
+            out = ' '
+        self.space = False
+        self.last = token[-1]
+        self.open_string = token[0] in '"\'' and not _CSS_STRING.fullmatch(token)
+        return out + token
+
+
+def minifier(media_type: str) -> Optional[Minifier]:
+    """The minifier for the media type, or None if it is not minified."""
+    if media_type in (MediaType.XHTML.value, MediaType.SVG.value):
+        return XMLMinifier()
+    if media_type == MediaType.CSS.value:
+        return CSSMinifier()
+    return None
+
+class MinifyingWriter:
+    """A text file object which writes the minified text into the `fileobj`,
+    counting the sizes in UTF-8 before and after."""
+
+    def __init__(self, fileobj: TextIO, minifier: Minifier) -> None:
+        self.fileobj = fileobj
+        self.minifier = minifier
+        self.original = 0
+        self.minified = 0
+
+    def write(self, text: str) -> int:
+        self.original += len(text.encode('utf-8'))
+        self._write(self.minifier.feed(text))
+        return len(text)
+
+    def close(self) -> None:
+        self._write(self.minifier.close())
+
+    def _write(self, text: str) -> None:
+        if text:
+            self.minified += len(text.encode('utf-8'))
+            self.fileobj.write(text)
+
+_XML_ENCODING = re.compile(rb'''<\?xml[^>]*?encoding[ \t\r\n]*=[ \t\r\n]*["']([A-Za-z][\w.-]*)["']''')
+_CSS_CHARSET = re.compile(rb'@charset "([A-Za-z][\w.-]*)";')
+
+def _encoding(head: bytes, media_type: str) -> str:
+    """The encoding of a document from its BOM, or the XML declaration or the
+    `@charset` rule at its head. UTF-8 by default."""
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    m = (_CSS_CHARSET if media_type == MediaType.CSS.value else _XML_ENCODING).match(head)
+    return m.group(1).decode('ascii') if m else 'utf-8'
+
+def minify_file(src: Path, target: Path, media_type: str) -> tuple[int, int]:
+    """Writes the minified `src` into the `target` chunk by chunk, in the
+    encoding of the `src`. The `src` is copied as is if it cannot be decoded.
+    Returns the sizes before and after."""
+    m = minifier(media_type)
+    assert m is not None
+    with open(src, 'rb') as f:
+        encoding = _encoding(f.read(1024), media_type)
+    try:
+        with open(src, encoding=encoding) as f, open(target, 'w', encoding=encoding) as out:
+            writer = MinifyingWriter(out, m)
+            while chunk := f.read(_CHUNK_SIZE):
+                writer.write(chunk)
+            writer.close()
+    except (UnicodeError, LookupError) as e:
+        logger.warning(f'copying "{src}" without minifying: {e}')
+        shutil.copyfile(src, target)
+    return src.stat().st_size, target.stat().st_size
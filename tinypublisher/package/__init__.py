@@ -1,10 +1,10 @@
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, asdict
 from enum import Enum
 from argparse import Namespace
 from pathlib import Path
-from uuid import uuid4, uuid5, NAMESPACE_DNS
+from uuid import uuid4, uuid5, NAMESPACE_DNS, NAMESPACE_URL
 from typing import Optional
-import os, magic
+import os, datetime, hashlib, json, magic
 
 
 class MediaType(Enum):
@@ -63,6 +63,20 @@ class PackageSpec:
     _language_tag: Optional[str] = None
     _id: Optional[str] = None
     _uuid: str = ''
+    _uuid_dns: Optional[str] = None
+    # stable timestamps and identifiers for the same inputs
+    reproducible: bool = False
+    # the number of consecutive images wrapped in a page. if 0, the images up
+    # to the next entry which has an index title are wrapped in a page
+    images_per_page: int = 1
+    # the table of contents is nested by the directories of the items
+    nav_folders: bool = False
+    # the entries of the table of contents are grouped by this number
+    nav_chunk: int = 0
+    # add a page-list navigation of all the spine items
+    page_list: bool = False
+    # strip the comments and the insignificant whitespace of the text documents
+    minify: bool = False
     
     def append_spine_item(self, **dargs) -> None:
         items = {k: dargs[k] for k in SpineItem.__dataclass_fields__ if dargs.__contains__(k)} # type: ignore
@@ -116,14 +130,76 @@ class PackageSpec:
         
     @property
     def uuid(self) -> str:
+        if self.reproducible and self._uuid_dns is None:
+            return uuid5(NAMESPACE_URL, f'urn:tinypublisher:{self.digest()}').urn
         return self._uuid
     @uuid.setter
     def uuid(self, dns: Optional[str]):
+        self._uuid_dns = dns
         if dns is None:
             self._uuid = uuid4().urn
         else:
             self._uuid = uuid5(NAMESPACE_DNS, dns).urn
 
+    @property
+    def modified_date(self) -> datetime.datetime:
+        """In the reproducible mode, `SOURCE_DATE_EPOCH` or the latest
+        modification time of the inputs is used instead of the current time."""
+        if not self.reproducible:
+            return datetime.datetime.utcnow().replace(microsecond=0)
+
+        epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        if epoch is None:
+            epoch = max((mtime // 10**9 for _, _, mtime in self.fingerprints()), default=0)
+        return datetime.datetime.utcfromtimestamp(int(epoch))
+
+    def input_paths(self) -> list[str]:
+        paths = {item.content_document for item in self.spine}
+        for item in self.spine:
+            if item.content_includes:
+                paths |= {uri for uri, _ in item.content_includes}
+        if self._cover_image:
+            paths.add(str(self._cover_image.resolve()))
+        return sorted(paths)
+
+    def fingerprints(self) -> list[tuple[str, int, int]]:
+        """(path, size, mtime_ns) of every input file."""
+        fingerprints = []
+        for path in self.input_paths():
+            st = os.stat(path)
+            fingerprints.append((path, st.st_size, st.st_mtime_ns))
+        return fingerprints
+
+    def digest(self) -> str:
+        """A digest of the spine and the metadata given explicitly. The
+        identifier generated by `uuid4()` is not included."""
+        base = self.curdir.resolve()
+        def loc(path: str) -> str:
+            return os.path.relpath(path, base)
+
+        spine = []
+        for item in self.spine:
+            d = asdict(item)
+            d['content_document'] = loc(item.content_document)
+            if item.content_includes:
+                d['content_includes'] = [(loc(uri), mime) for uri, mime in item.content_includes]
+            spine.append(d)
+        source = {
+            'spine': spine,
+            'book_title': self.book_title,
+            'author': self.author,
+            'cover_image': loc(str(self._cover_image.resolve())) if self._cover_image else None,
+            'language_tag': self._language_tag,
+            'id': self._id,
+            'uuid': self._uuid_dns,
+            'images_per_page': self.images_per_page,
+            'nav': (self.nav_folders, self.nav_chunk, self.page_list),
+        }
+        if self.minify:
+            source['minify'] = True
+        text = json.dumps(source, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
     def find_from_spine_item(self, attr: str) -> Optional[str]:
         for item in self.spine:
             if attr in set(item.__dataclass_fields__.keys()): # type: ignore
@@ -0,0 +1,166 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Optional, TextIO
+import json, threading, time
+
+import tinypublisher as app
+
+import logging
+logger = logging.getLogger(f'{app.__appname__}.progress')
+
+
+class Progress:
+    """Receives the progress of the stages of a build, e.g. packaging the
+    items and zipping them. This one ignores it."""
+
+    def start(self, stage: str, total: int) -> None:
+        pass
+
+    def advance(self, items: int = 1, nbytes: int = 0) -> None:
+        pass
+
+    def finish(self) -> None:
+        pass
+
+
+@dataclass
+class _Stage:
+    name: str
+    total: int
+    done: int = 0
+    nbytes: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def elapsed(self, now: float) -> float:
+        return max(now - self.started, 1e-9)
+
+class _RateLimited(Progress):
+    """Reports at most once per `interval` seconds while a stage advances.
+    The stages may be advanced on several threads."""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stage: Optional[_Stage] = None
+        self.reported = 0.0
+
+    def start(self, stage: str, total: int) -> None:
+        with self.lock:
+            self.stage = _Stage(stage, total)
+            self.reported = self.stage.started
+            self.report_start(self.stage)
+
+    def advance(self, items: int = 1, nbytes: int = 0) -> None:
+        with self.lock:
+            if self.stage is None:
+                return
+            self.stage.done += items
+            self.stage.nbytes += nbytes
+            now = time.monotonic()
+            if now - self.reported >= self.interval:
+                self.reported = now
+                self.report(self.stage, now)
+
+    def finish(self) -> None:
+        with self.lock:
+            if self.stage is None:
+                return
+            self.report_finish(self.stage, time.monotonic())
+            self.stage = None
+
+    def report_start(self, stage: _Stage) -> None:
+        pass
+
+    def report(self, stage: _Stage, now: float) -> None:
+        pass
+
+    def report_finish(self, stage: _Stage, now: float) -> None:
+        pass
+
+class ProgressBar(_RateLimited):
+    """Redraws a line of the stage, the items and bytes per second and the
+    ETA on a terminal. On other streams, only a line for each finished stage
+    is written."""
+
+    def __init__(self, stream: TextIO, interval: float = 0.1, width: int = 24) -> None:
+        super().__init__(interval)
+        self.stream = stream
+        self.width = width
+        self.tty = stream.isatty()
+
+    def report(self, stage: _Stage, now: float) -> None:
+        if self.tty:
+            self.stream.write('\r' + self.line(stage, now) + '\x1b[K')
+            self.stream.flush()
+
+    def report_finish(self, stage: _Stage, now: float) -> None:
+        self.stream.write(('\r' if self.tty else '') + self.line(stage, now, True) +
+                          ('\x1b[K' if self.tty else '') + '\n')
+        self.stream.flush()
+
+    def line(self, stage: _Stage, now: float, finished: bool = False) -> str:
+        elapsed = stage.elapsed(now)
+        rate = stage.done / elapsed
+        speed = f'{rate:.0f} items/s {_bytes(stage.nbytes / elapsed)}/s'
+        if finished:
+            return f'{stage.name}: {stage.done} items, {_bytes(stage.nbytes)} in {elapsed:.2f}s ({speed})'
+        ratio = min(stage.done / stage.total, 1.0) if stage.total else 1.0
+        filled = int(ratio * self.width)
+        bar = '#' * filled + '.' * (self.width - filled)
+        eta = _duration((stage.total - stage.done) / rate) if rate and stage.total else '-'
+        return f'{stage.name} [{bar}] {stage.done}/{stage.total} {speed} ETA {eta}'
+
+class EventStream(_RateLimited):
+    """Writes the progress as JSON lines of the events "start", "progress"
+    (at most once per `interval` seconds) and "finish"."""
+
+    def __init__(self, stream: TextIO, interval: float = 0.5) -> None:
+        super().__init__(interval)
+        self.stream = stream
+
+    def report_start(self, stage: _Stage) -> None:
+        self.write({'event': 'start', 'stage': stage.name, 'total': stage.total})
+
+    def report(self, stage: _Stage, now: float) -> None:
+        self.write(self.event('progress', stage, now))
+
+    def report_finish(self, stage: _Stage, now: float) -> None:
+        self.write(self.event('finish', stage, now))
+
+    def event(self, name: str, stage: _Stage, now: float) -> dict:
+        return {'event': name, 'stage': stage.name, 'done': stage.done, 'total': stage.total,
+                'bytes': stage.nbytes, 'elapsed': round(now - stage.started, 3)}
+
+    def write(self, event: dict) -> None:
+        self.stream.write(json.dumps(event) + '\n')
+        self.stream.flush()
+
+class ProgressGroup(Progress):
+    """Passes the progress to all of the `progresses`."""
+
+    def __init__(self, *progresses: Progress) -> None:
+        self.progresses = progresses
+
+    def start(self, stage: str, total: int) -> None:
+        for progress in self.progresses:
+            progress.start(stage, total)
+
+    def advance(self, items: int = 1, nbytes: int = 0) -> None:
+        for progress in self.progresses:
+            progress.advance(items, nbytes)
+
+    def finish(self) -> None:
+        for progress in self.progresses:
+            progress.finish()
+
+
+def _bytes(n: float) -> str:
+    for unit in ['B', 'KiB', 'MiB']:
+        if n < 1024:
+            return f'{n:.1f} {unit}' if unit != 'B' else f'{n:.0f} B'
+        n /= 1024
+    return f'{n:.1f} GiB'
+
+def _duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}'
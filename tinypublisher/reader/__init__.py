@@ -1,8 +1,9 @@
-import io, csv, mimetypes, re
+import codecs, io, os, csv, json, mimetypes, re, struct, time, zlib
 import xml.etree.ElementTree as ET
-from pathlib import Path
-from dataclasses import dataclass
-from typing import Optional, Any, Iterable
+from pathlib import Path, PurePosixPath
+from dataclasses import dataclass, field
+from typing import Optional, Any, BinaryIO, Iterable, Iterator, Union
+from concurrent.futures import Executor
 import magic
 
 import tinypublisher as app
@@ -24,31 +25,111 @@ class _State:
 
 _SpineItem = dict[str, Any]
 
+_Fingerprint = tuple[str, int, int]
+
+@dataclass
+class _Inspection:
+    fingerprints: list[_Fingerprint]
+    spine_item: _SpineItem
+    def fresh(self) -> bool:
+        try:
+            return all(_fingerprint(fp[0]) == fp for fp in self.fingerprints)
+        except OSError:
+            return False
+
+def _fingerprint(path: str) -> _Fingerprint:
+    """(path, size, mtime_ns) of the file, or (path, -1, -1) if it is missing."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return (path, -1, -1)
+    return (path, st.st_size, st.st_mtime_ns)
+
+@dataclass
+class _Linked:
+    """The deadline of an entry of the file list, and the files reached from
+    it while it is inspected."""
+    deadline: float
+    # the files inspected for the entry, which are not inspected again
+    visited: set[Path]
+    # the linked local files which do not exist
+    missing: set[str] = field(default_factory=set)
+
+@dataclass
+class InspectionLimits:
+    """The limits on each XHTML, SVG or CSS file inspected, which are checked
+    while the file is read. The time is counted for each entry of the file
+    list, together with its linked resources."""
+    max_bytes: int = 256 * 1024 * 1024
+    max_elements: int = 1000000
+    max_depth: int = 256
+    max_seconds: float = 30.0
+
 
 class FileListParser:
-    def __init__(self, curdir='.'):
+    def __init__(self, curdir='.', limits: Optional[InspectionLimits] = None):
         self.curdir = Path(curdir)
+        self.limits = limits or InspectionLimits()
+        # inspected files and their linked resources, reused while unchanged
+        self.inspected: dict[str, _Inspection] = {}
 
     def parse(self, fileobj: io.TextIOBase) -> PackageSpec:
         lines = csv.reader(fileobj, delimiter="\t")
+        return self.parse_entries(lines)
+
+    def parse_entries(self, entries: Iterable[list[str]]) -> PackageSpec:
         spec = PackageSpec(curdir=self.curdir)
         s = _State(0, 0)
-        for entry in lines:
+        for entry in entries:
             if entry:
                 spine_item = self.parseEntry(entry, s)
                 spec.append_spine_item(**spine_item)
                 s.succ_row()
         return spec
+
+    def parse_dir(self, include: Iterable[str] = (), exclude: Iterable[str] = (),
+                  titles: bool = False) -> PackageSpec:
+        """Makes the spec from the files under the `curdir` instead of a file
+        list. See `scan_dir`."""
+        return self.parse_entries(scan_dir(self.curdir, include, exclude, titles))
     
     def parse_text(self, text: str) -> PackageSpec:
         return self.parse(io.StringIO(text))
 
+    async def parse_async(self, fileobj: io.TextIOBase,
+                          executor: Optional[Executor] = None, maxsize: int = 64) -> PackageSpec:
+        """Same as `parse`, but each entry is inspected on the `executor`.
+        At most `maxsize` entries are inspected ahead of the spec being filled."""
+        lines = csv.reader(fileobj, delimiter="\t")
+        rows = enumerate(entry for entry in lines if entry)
+        spec = PackageSpec(curdir=self.curdir)
+        parse_row = lambda row: self.parseEntry(row[1], _State(row[0], 0))
+        async for spine_item in app.executor_map(parse_row, rows, executor, maxsize):
+            spec.append_spine_item(**spine_item)
+        return spec
+
+    def compile(self, fileobj: io.TextIOBase, target: BinaryIO) -> PackageSpec:
+        """`parse` and write the snapshot of the file list and its inspections
+        into the `target`. See `load_snapshot`."""
+        rows = [entry for entry in csv.reader(fileobj, delimiter="\t") if entry]
+        spec = self.parse_entries(rows)
+        paths = {item.content_document for item in spec.spine}
+        inspected = [[inspection.fingerprints, inspection.spine_item]
+                     for path, inspection in self.inspected.items() if path in paths]
+        _write_snapshot(target, {
+            'version': app.__version__,
+            'curdir': str(self.curdir.resolve()),
+            'rows': rows,
+            'inspected': inspected,
+        })
+        return spec
+
     def parseEntry(self, entry: list[str], state: _State) -> _SpineItem:
         spine_item: _SpineItem = {}
 
         path = (self.curdir / entry[state.col]).resolve()
         spine_item['content_document'] = str(path)
-        spine_item |= _check_file_type(path, state)
+        spine_item |= self.inspect(path, state)
 
         state.succ_col()
         index_title = entry[state.col] if len(entry) > state.col else ''
@@ -70,11 +151,122 @@ class FileListParser:
 
         return spine_item
 
+    def inspect(self, path: Path, state: _State) -> _SpineItem:
+        cached = self.inspected.get(str(path))
+        if cached is not None and cached.fresh():
+            return dict(cached.spine_item)
+
+        linked = _Linked(time.monotonic() + self.limits.max_seconds, {path})
+        spine_item = _check_file_type(path, state, self.limits, linked)
+        paths = ([str(path)] + [uri for uri, _ in spine_item.get('content_includes', [])] +
+                 sorted(linked.missing))
+        self.inspected[str(path)] = _Inspection([_fingerprint(p) for p in paths], spine_item)
+        return dict(spine_item)
+
+    def input_paths(self, spec: PackageSpec) -> list[str]:
+        """The paths of the files inspected for the `spec`, including the
+        linked ones which do not exist, so that they are watched too."""
+        paths = {fp[0] for item in spec.spine
+                 if (inspection := self.inspected.get(item.content_document))
+                 for fp in inspection.fingerprints}
+        return sorted(paths)
+
     
 
+# Snapshot
+
+SNAPSHOT_MAGIC = b'TPSPEC'
+SNAPSHOT_FORMAT = 1
+
+class SnapshotError(app.AppBaseError):
+    def __init__(self, message: str):
+        self.message = message
+
+def _write_snapshot(target: BinaryIO, payload: dict[str, Any]) -> None:
+    data = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    target.write(SNAPSHOT_MAGIC + struct.pack('<H', SNAPSHOT_FORMAT))
+    target.write(zlib.compress(data, 9))
+
+def load_snapshot(source: BinaryIO, limits: Optional[InspectionLimits] = None) -> PackageSpec:
+    """Makes the spec from a snapshot written by `FileListParser.compile`.
+    Only the entries whose inputs were modified since are inspected again,
+    within the `limits`. The snapshot of another version of tinypublisher is
+    used only for its file list."""
+    header = source.read(len(SNAPSHOT_MAGIC) + 2)
+    if len(header) != len(SNAPSHOT_MAGIC) + 2 or header[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise SnapshotError('The file is not a snapshot of a file list.')
+    (fmt,) = struct.unpack('<H', header[len(SNAPSHOT_MAGIC):])
+    if fmt != SNAPSHOT_FORMAT:
+        raise SnapshotError(f'The snapshot format {fmt} is not supported.')
+    try:
+        payload = json.loads(zlib.decompress(source.read()))
+    except (zlib.error, ValueError) as e:
+        raise SnapshotError(f'The snapshot is broken: {e}')
+
+    parser = FileListParser(payload['curdir'], limits)
+    if payload['version'] == app.__version__:
+        for fingerprints, spine_item in payload['inspected']:
+            if 'content_size' in spine_item:
+                spine_item['content_size'] = tuple(spine_item['content_size'])
+            if 'content_includes' in spine_item:
+                spine_item['content_includes'] = [tuple(link) for link in spine_item['content_includes']]
+            parser.inspected[fingerprints[0][0]] = _Inspection(
+                [tuple(fp) for fp in fingerprints], spine_item) # type: ignore
+    return parser.parse_entries(payload['rows'])
+
+
+
+_SCANNED_TYPES = {
+    MediaType.GIF.value,
+    MediaType.JPG.value,
+    MediaType.PNG.value,
+    MediaType.SVG.value,
+    MediaType.XHTML.value,
+}
+
+def scan_dir(curdir: Path, include: Iterable[str] = (), exclude: Iterable[str] = (),
+             titles: bool = False) -> Iterator[list[str]]:
+    """Yields the entries of a file list for the files under the `curdir`, in
+    the natural order of their names ("2.jpg" comes before "10.jpg").
+
+    The paths relative to the `curdir` are matched against the `include` and
+    `exclude` glob patterns. Without `include`, the image, XHTML and SVG files
+    are yielded. If `titles` is true, the file stem is used as the index title.
+    Hidden files and the build dirs are skipped, and the symbolic links to
+    dirs are not followed."""
+    include, exclude = list(include), list(exclude)
+    def wanted(loc: PurePosixPath) -> bool:
+        if any(loc.match(pat) for pat in exclude):
+            return False
+        if include:
+            return any(loc.match(pat) for pat in include)
+        mime, _ = mimetypes.guess_type(loc.name)
+        return mime in _SCANNED_TYPES
+
+    for loc in _scan(curdir, PurePosixPath()):
+        if wanted(loc):
+            yield [str(loc), Path(loc.name).stem] if titles else [str(loc)]
+
+def _scan(curdir: Path, loc: PurePosixPath) -> Iterator[PurePosixPath]:
+    with os.scandir(curdir / loc) as it:
+        entries = sorted((e for e in it if not e.name.startswith('.')),
+                         key=lambda e: (_natural_key(e.name), e.name))
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if os.path.exists(os.path.join(entry.path, '.' + app.__appname__)):
+                continue
+            yield from _scan(curdir, loc / entry.name)
+        elif entry.is_file():
+            yield loc / entry.name
+
+def _natural_key(name: str) -> list[Union[int, str]]:
+    return [int(t) if t.isdecimal() else t.lower() for t in re.split(r'(\d+)', name)]
+
+
 class BaseError(app.AppBaseError):
     def __init__(self, message: str, state: str):
         self.message = f'{message} [{state}]'
+        super().__init__(self.message)
         
 class ReaderError(BaseError):
     def __init__(self, message: str, state: _State):
@@ -82,7 +274,8 @@ class ReaderError(BaseError):
 
         
         
-def _check_file_type(path: Path, state: _State) -> _SpineItem:
+def _check_file_type(path: Path, state: _State, limits: InspectionLimits,
+                     linked: _Linked) -> _SpineItem:
     if not path.is_file():
         raise ReaderError(f'"{path}" is nonexist or not a regular file.', state)
 
@@ -96,7 +289,7 @@ def _check_file_type(path: Path, state: _State) -> _SpineItem:
     spine_item = _SpineItem({'media_type': mime}) 
 
     if MediaType.predict_content_document(mime):
-        spine_item |= _check_content_document(path, mime)
+        spine_item |= _check_content_document(path, mime, state, limits, linked)
 
     if mime.startswith('image/'):
         spine_item |= _image_size(magic.from_file(str(path)))
@@ -117,15 +310,88 @@ def _image_size(spec: Optional[str]) -> _SpineItem:
         
 
 
+# Limits
+
+_CHUNK_SIZE = 64 * 1024
+# the longest `url(...)` of a CSS file which is read
+_MAX_CSS_URL = 64 * 1024
+
+class _Guard:
+    """Checks the `limits` while the file is read, and the `deadline` of
+    the entry of the file list. A violation is a `ReaderError` at the entry."""
+    def __init__(self, path: Path, state: _State, limits: InspectionLimits, deadline: float):
+        self.path = path
+        self.state = state
+        self.limits = limits
+        self.deadline = deadline
+        self.nbytes = 0
+        self.elements = 0
+        self.depth = 0
+        if path.stat().st_size > limits.max_bytes:
+            self.fail(f'is larger than {limits.max_bytes} bytes')
+
+    def read(self, nbytes: int) -> None:
+        self.nbytes += nbytes
+        if self.nbytes > self.limits.max_bytes:
+            self.fail(f'is larger than {self.limits.max_bytes} bytes')
+        self.check_time()
+
+    def start(self) -> None:
+        self.elements += 1
+        self.depth += 1
+        if self.elements > self.limits.max_elements:
+            self.fail(f'has more than {self.limits.max_elements} elements')
+        if self.depth > self.limits.max_depth:
+            self.fail(f'nests elements deeper than {self.limits.max_depth}')
+        if self.elements % 1024 == 0:
+            self.check_time()
+
+    def end(self) -> None:
+        self.depth -= 1
+
+    def check_time(self) -> None:
+        if time.monotonic() > self.deadline:
+            self.fail(f'takes longer than {self.limits.max_seconds} seconds to inspect')
+
+    def fail(self, reason: str) -> None:
+        raise ReaderError(f'"{self.path}" {reason}.', self.state)
+
+def _parse_limited(path: Path, guard: _Guard) -> ET.Element:
+    """`ET.parse` the file chunk by chunk, within the limits of the `guard`."""
+    parser = ET.XMLPullParser(('start', 'end'))
+    root = None
+    def check_events() -> None:
+        nonlocal root
+        for event, elm in parser.read_events():
+            if event == 'start':
+                root = elm if root is None else root
+                guard.start()
+            else:
+                guard.end()
+
+    try:
+        with open(path, 'rb') as f:
+            while chunk := f.read(_CHUNK_SIZE):
+                guard.read(len(chunk))
+                parser.feed(chunk)
+                check_events()
+        parser.close()
+    except ET.ParseError as e:
+        guard.fail(f'cannot be parsed: {e}')
+    check_events()
+    assert root is not None
+    return root
+
+
 class ContentDocumentError(Exception):
     def __init__(self, message: str, state):
         super().__init__(message, f'line: {state.row}')
 
-def _check_content_document(path: Path, mime: str) -> _SpineItem:
-    logger.info(f'checking "{path.name}"')
+def _check_content_document(path: Path, mime: str, state: _State, limits: InspectionLimits,
+                            linked: _Linked) -> _SpineItem:
+    logger.debug('checking "%s"', path.name)
 
-    tree = ET.parse(path)
-    root = tree.getroot()
+    root = _parse_limited(path, _Guard(path, state, limits, linked.deadline))
     links = []
     title = root.find('.//{*}title')
 
@@ -134,7 +400,7 @@ def _check_content_document(path: Path, mime: str) -> _SpineItem:
     elif mime.endswith('svg+xml'):
         links = _find_linked_in_svg(root)
 
-    validated_links = _validated_links(links, path)
+    validated_links = _validated_links(links, path, state, limits, linked)
     spine_item = _SpineItem({'content_includes': validated_links}) if validated_links else {}
     if title is not None and title.text:
         spine_item['content_title'] = title.text.strip()
@@ -170,7 +436,12 @@ def _content_text(elements: Iterable) -> str:
     return text
 
 
-def _validated_links(uris: list[str], current: Path) -> list[tuple[str,str]]:
+def _validated_links(uris: list[str], current: Path, state: _State, limits: InspectionLimits,
+                     linked: _Linked) -> list[tuple[str,str]]:
+    """The links of the `current` file and of the files linked from them.
+    A file already inspected for the same entry is not inspected again, so
+    that the links may make a cycle. The missing files are recorded in the
+    `linked`."""
     re_invalid = re.compile(f'^(?:https?|mailto|urn):|({current.name})?#')
     re_foreign = re.compile('^https?:')
     links = set()
@@ -187,6 +458,7 @@ def _validated_links(uris: list[str], current: Path) -> list[tuple[str,str]]:
         if not path.is_file():
             logger.warning(f'''"{current}" references to a nonexistant local file
   -- {uri}.''')
+            linked.missing.add(str(path))
             continue
 
         mime = magic.from_file(str(path), mime=True)
@@ -194,28 +466,48 @@ def _validated_links(uris: list[str], current: Path) -> list[tuple[str,str]]:
             mime, _ = mimetypes.guess_type(path)
 
         links.add((str(path.absolute()), mime))
+        if path in linked.visited:
+            continue
+        linked.visited.add(path)
 
         additionals: list[tuple[str,str]] = []
         if MediaType.predict_content_document(mime):
-            spine = _check_content_document(path, mime)
+            spine = _check_content_document(path, mime, state, limits, linked)
             if spine.__contains__('content_includes'):
                 additionals = spine['content_includes']
         elif mime == 'text/css':
-            additionals = _find_linked_in_css(path)
+            additionals = _find_linked_in_css(path, state, limits, linked)
 
         if additionals:
             links = links | set(additionals)
 
-    return list(links)
+    return sorted(links)
 
-def _find_linked_in_css(path: Path) -> list[tuple[str,str]]:
+def _find_linked_in_css(path: Path, state: _State, limits: InspectionLimits,
+                        linked: _Linked) -> list[tuple[str,str]]:
     re_url = re.compile('url\([\'"]?([^\("\']+)[\'"]?\)')
     links = set()
-    with open(path) as f:
-        for line in f:
-            links |= set(re_url.findall(line))
-
-    return _validated_links(list(links), path)
+    guard = _Guard(path, state, limits, linked.deadline)
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    text = ''
+    with open(path, 'rb') as f:
+        while chunk := f.read(_CHUNK_SIZE):
+            guard.read(len(chunk))
+            text += decoder.decode(chunk)
+            # an unclosed `url(` or the end which may begin one is held
+            start = text.rfind('url(')
+            if start >= 0 and text.find(')', start) < 0:
+                end = start
+            else:
+                end = max(len(text) - 3, text.find(')', start) + 1 if start >= 0 else 0)
+            links |= set(re_url.findall(text, 0, end))
+            text = text[end:]
+            if len(text) > _MAX_CSS_URL:
+                # too long to be a local file, like a data URI
+                text = text[-3:]
+    links |= set(re_url.findall(text + decoder.decode(b'', True)))
+
+    return _validated_links(list(links), path, state, limits, linked)
     
 def _find_linked_in_xhtml(root: ET.Element) -> list[str]:
     re_href = re.compile('\{.+\}link')
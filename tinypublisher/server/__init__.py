@@ -0,0 +1,298 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from typing import Optional
+import csv, io, re, shutil, tempfile, threading, time, urllib.parse, zipfile
+
+import tinypublisher as app
+from tinypublisher.package import PackageSpec
+from tinypublisher.reader import FileListParser, InspectionLimits
+from tinypublisher.builder import PackageBuilder
+import tinypublisher.builder as builder
+
+import logging
+logger = logging.getLogger(f'{app.__appname__}.server')
+
+
+class ServerError(app.AppBaseError):
+    def __init__(self, message: str):
+        self.message = message
+
+_CHUNK_SIZE = 1024 * 1024
+_MAX_BODY = 256 * 1024 * 1024
+_MAX_SOURCES_SIZE = 1024 * 1024 * 1024
+_MAX_SOURCES_MEMBERS = 100000
+_MAX_PARSERS = 16
+_TEMPLATES = ['container.xml', 'package.opf', 'navigation.xhtml', 'page.xhtml']
+
+
+@dataclass
+class _Job:
+    name: str
+    options: dict[str, str]
+    spine: str = ''
+    curdir: str = ''
+    sources: bytes = b''
+    limits: Optional[InspectionLimits] = None
+
+@dataclass
+class _Result:
+    epub: str = ''
+    tmpdir: str = ''
+    error: str = ''
+    timings: dict[str, float] = field(default_factory=dict)
+
+
+# Workers
+
+# curdir -> the parser, kept in each worker to reuse its inspections,
+# the least recently used first
+_parsers: OrderedDict[str, FileListParser] = OrderedDict()
+
+def _init_worker() -> None:
+    logging.getLogger(app.__appname__).setLevel(logging.WARNING)
+    for name in _TEMPLATES:
+        builder._template(name)
+
+def _ping() -> None:
+    pass
+
+def _configure(spec: PackageSpec, name: str, options: dict[str, str]) -> None:
+    spec.book_title = options.get('title', name)
+    spec.author = options.get('author', spec.author)
+    spec.language_tag = options.get('language')
+    spec.id = options.get('id')
+    spec.uuid = options.get('uuid')
+    spec.reproducible = options.get('reproducible', '') not in ('', '0', 'false')
+    spec.images_per_page = int(options.get('images-per-page', 1))
+    spec.nav_folders = options.get('nav-folders', '') not in ('', '0', 'false')
+    spec.nav_chunk = int(options.get('nav-chunk', 0))
+    spec.page_list = options.get('page-list', '') not in ('', '0', 'false')
+    spec.minify = options.get('minify', '') not in ('', '0', 'false')
+    if options.get('cover'):
+        cover = (spec.curdir / options['cover']).resolve()
+        if not cover.is_relative_to(spec.curdir.resolve()):
+            raise ServerError(f'The cover "{options["cover"]}" is not under the dir.')
+        spec.cover_image = str(cover)
+
+def _parser(curdir: str, limits: Optional[InspectionLimits]) -> FileListParser:
+    parser = _parsers.pop(curdir, None) or FileListParser(Path(curdir), limits)
+    _parsers[curdir] = parser
+    while len(_parsers) > _MAX_PARSERS:
+        _parsers.popitem(last=False)
+    return parser
+
+def _extract(sources: bytes, curdir: Path) -> None:
+    with zipfile.ZipFile(io.BytesIO(sources)) as zf:
+        members = zf.infolist()
+        if len(members) > _MAX_SOURCES_MEMBERS:
+            raise ServerError(f'The sources have more than {_MAX_SOURCES_MEMBERS} files.')
+        if sum(info.file_size for info in members) > _MAX_SOURCES_SIZE:
+            raise ServerError(f'The sources are larger than {_MAX_SOURCES_SIZE} bytes.')
+        zf.extractall(curdir)
+
+def _confined_rows(spine: str, curdir: Path) -> list[list[str]]:
+    """The rows of the file list, whose paths should be under the `curdir`,
+    so that no file outside it is inspected."""
+    rows = [entry for entry in csv.reader(io.StringIO(spine), delimiter='\t') if entry]
+    for entry in rows:
+        if not (curdir / entry[0]).resolve().is_relative_to(curdir.resolve()):
+            raise ServerError(f'"{entry[0]}" is not under the dir.')
+    return rows
+
+def _build(job: _Job) -> _Result:
+    """Builds the package of the job in a worker. A package from uploaded
+    sources is built in a temporary dir, which the caller removes."""
+    result = _Result()
+    timings = result.timings
+    try:
+        start = time.perf_counter()
+        if job.sources:
+            result.tmpdir = tempfile.mkdtemp(prefix=f'{app.__appname__}-')
+            curdir = Path(result.tmpdir).resolve()
+            _extract(job.sources, curdir)
+            spine_name = job.options.get('spine', 'spine.tsv')
+            spine_path = (curdir / spine_name).resolve()
+            if not spine_path.is_relative_to(curdir):
+                raise ServerError(f'The file list "{spine_name}" is not in the sources.')
+            if not spine_path.is_file():
+                raise ServerError(f'The sources have no file list "{spine_name}".')
+            spine = spine_path.read_text()
+            parser = FileListParser(curdir, job.limits)
+        else:
+            curdir = Path(job.curdir)
+            spine = job.spine
+            parser = _parser(job.curdir, job.limits)
+        timings['extract'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        spec = parser.parse_entries(_confined_rows(spine, curdir))
+        _configure(spec, job.name, job.options)
+        timings['parse'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        packager = PackageBuilder(job.name)
+        packager.build_with(spec)
+        timings['build'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        packager.zipup()
+        timings['zip'] = time.perf_counter() - start
+        result.epub = str(packager.destdir.parent / (packager.packagename + '.epub'))
+    except app.AppBaseError as e:
+        result.error = getattr(e, 'message', str(e))
+    except Exception as e:
+        result.error = f'{type(e).__name__}: {e}'
+    return result
+
+
+
+# Server
+
+class BuildServer(ThreadingHTTPServer):
+    """Builds EPUB packages for HTTP requests on a pool of worker processes,
+    which are started beforehand and keep the templates and the inspections
+    of the file lists warm.
+
+    `POST /build?name=<package-name>&...` takes either a file list whose paths
+    are relative to `dir`, a dir under the `root`, or a zip of the sources
+    with the file list `spine` (default "spine.tsv"). The other parameters
+    are the options of the command, like `title` or `nav-folders=1`. The
+    files are inspected within the `limits`."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], root: Path, workers: int = 1,
+                 limits: Optional[InspectionLimits] = None) -> None:
+        super().__init__(address, _Handler)
+        self.root = root.resolve()
+        self.limits = limits
+        self.workers = workers
+        self.pool = self._start_pool()
+        self.pool_lock = threading.Lock()
+        # builds of a package in a dir are serialized, since they share the build dir
+        self.locks: dict[tuple[str, str], threading.Lock] = {}
+        self.locks_lock = threading.Lock()
+
+    def _start_pool(self) -> ProcessPoolExecutor:
+        pool = ProcessPoolExecutor(self.workers, initializer=_init_worker)
+        for future in [pool.submit(_ping) for _ in range(self.workers)]:
+            future.result()
+        return pool
+
+    def lock(self, curdir: str, name: str) -> threading.Lock:
+        with self.locks_lock:
+            return self.locks.setdefault((curdir, name), threading.Lock())
+
+    def build(self, job: _Job) -> _Result:
+        """Builds the job on the pool. A pool broken by a dead worker is
+        replaced for the later jobs, and the error is raised again."""
+        pool = self.pool
+        try:
+            return pool.submit(_build, job).result()
+        except BrokenProcessPool:
+            with self.pool_lock:
+                if self.pool is pool:
+                    logger.error('a worker died, restarting the pool')
+                    pool.shutdown(wait=False)
+                    self.pool = self._start_pool()
+            raise
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.shutdown()
+
+class _Handler(BaseHTTPRequestHandler):
+    server: BuildServer
+    server_version = f'{app.__appname__}/{app.__version__}'
+
+    def do_POST(self) -> None:
+        start = time.perf_counter()
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/build':
+            self.send_error(404)
+            return
+        options = dict(urllib.parse.parse_qsl(url.query))
+        name = options.pop('name', 'book')
+        if not re.fullmatch(r'[\w-][\w.-]*', name):
+            self.send_error(400, explain=f'"{name}" is not a package name.')
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.send_error(400, explain='The Content-Length is not a number.')
+            return
+        if not 0 <= length <= _MAX_BODY:
+            self.send_error(413, explain=f'The body should be at most {_MAX_BODY} bytes.')
+            return
+        body = self.rfile.read(length)
+
+        try:
+            if self.headers.get_content_type() in ('application/zip', 'application/x-zip-compressed'):
+                job = _Job(name, options, sources=body, limits=self.server.limits)
+                lock = None
+            else:
+                dirname = options.pop('dir', '.')
+                curdir = (self.server.root / dirname).resolve()
+                if not curdir.is_relative_to(self.server.root) or not curdir.is_dir():
+                    raise ServerError(f'"{dirname}" is not a dir under the root.')
+                job = _Job(name, options, spine=body.decode('utf-8'), curdir=str(curdir),
+                           limits=self.server.limits)
+                lock = self.server.lock(job.curdir, name)
+        except (ServerError, UnicodeDecodeError) as e:
+            self.send_error(400, explain=getattr(e, 'message', str(e)))
+            return
+
+        result: Optional[_Result] = None
+        queued = time.perf_counter()
+        if lock:
+            lock.acquire()
+        try:
+            try:
+                result = self.server.build(job)
+            except BrokenProcessPool:
+                self.send_error(500, explain='The worker of the build died.')
+                return
+            result.timings['queue'] = (time.perf_counter() - queued -
+                                       sum(result.timings.values()))
+            if result.error:
+                self.send_error(422, explain=result.error)
+                return
+            self.send_epub(Path(result.epub), name, result.timings, start)
+        finally:
+            if lock:
+                lock.release()
+            if result and result.tmpdir:
+                shutil.rmtree(result.tmpdir, ignore_errors=True)
+
+    def send_epub(self, epub: Path, name: str, timings: dict[str, float], start: float) -> None:
+        timings['total'] = time.perf_counter() - start
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/epub+zip')
+        self.send_header('Content-Length', str(epub.stat().st_size))
+        self.send_header('Content-Disposition', f'attachment; filename="{name}.epub"')
+        self.send_header('Server-Timing', _server_timing(timings))
+        self.end_headers()
+        with open(epub, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile, _CHUNK_SIZE)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.info(format % args)
+
+def _server_timing(timings: dict[str, float]) -> str:
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items())
+
+def serve(root: Path, host: str = '127.0.0.1', port: int = 8000, workers: int = 1,
+          limits: Optional[InspectionLimits] = None) -> None:
+    """Runs the build server until interrupted."""
+    with BuildServer((host, port), root, workers, limits) as server:
+        logger.info(f'serving on http://{host}:{server.server_address[1]}/build '
+                    f'with {workers} workers (Ctrl-C to stop)')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,113 @@
+"""Sends build requests to a `tinypublish-serve` server concurrently and reports
+the throughput, the latencies and the mean `Server-Timing` of the builds.
+
+    python -m tinypublisher.server.loadgen http://127.0.0.1:8000 -s spine.tsv -n 100 -c 8
+    python -m tinypublisher.server.loadgen http://127.0.0.1:8000 --zip sources/ -n 100 -c 8
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import argparse, io, statistics, sys, time, urllib.error, urllib.parse, urllib.request, zipfile
+
+
+@dataclass
+class Report:
+    requests: int = 0
+    failures: int = 0
+    elapsed: float = 0.0
+    latencies: list[float] = field(default_factory=list)
+    timings: dict[str, list[float]] = field(default_factory=dict)
+
+    def __str__(self) -> str:
+        lines = [f'requests: {self.requests} ({self.failures} failed) in {self.elapsed:.2f}s',
+                 f'throughput: {self.requests / self.elapsed:.1f} req/s']
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            p = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+            lines.append(f'latency: p50 {p(0.5):.1f}ms, p90 {p(0.9):.1f}ms, p99 {p(0.99):.1f}ms')
+        for name, durations in self.timings.items():
+            lines.append(f'  {name}: {statistics.mean(durations):.1f}ms')
+        return '\n'.join(lines)
+
+
+def zip_sources(srcdir: Path) -> bytes:
+    f = io.BytesIO()
+    with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for p in sorted(srcdir.rglob('*')):
+            if p.is_file():
+                zf.write(p, p.relative_to(srcdir).as_posix())
+    return f.getvalue()
+
+def _parse_server_timing(header: str) -> dict[str, float]:
+    timings = {}
+    for metric in header.split(','):
+        name, _, params = metric.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'dur':
+                timings[name] = float(value)
+    return timings
+
+def run(url: str, body: bytes, content_type: str, requests: int, concurrency: int,
+        params: Optional[dict[str, str]] = None) -> Report:
+    """Posts the `body` to the build endpoint `requests` times on `concurrency`
+    threads."""
+    endpoint = url.rstrip('/') + '/build'
+    if params:
+        endpoint += '?' + urllib.parse.urlencode(params)
+    report = Report()
+
+    def post(_: int) -> Optional[tuple[float, dict[str, float]]]:
+        start = time.perf_counter()
+        request = urllib.request.Request(endpoint, body, {'Content-Type': content_type})
+        try:
+            with urllib.request.urlopen(request) as res:
+                res.read()
+                timing = res.headers.get('Server-Timing', '')
+        except (urllib.error.URLError, OSError):
+            return None
+        return time.perf_counter() - start, _parse_server_timing(timing)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for result in executor.map(post, range(requests)):
+            report.requests += 1
+            if result is None:
+                report.failures += 1
+                continue
+            latency, timings = result
+            report.latencies.append(latency)
+            for name, duration in timings.items():
+                report.timings.setdefault(name, []).append(duration)
+    report.elapsed = time.perf_counter() - start
+    return report
+
+def main(argv: Optional[list[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog='python -m tinypublisher.server.loadgen',
+                                     description='Load a tinypublish build server.')
+    parser.add_argument('url', help='the server, e.g. http://127.0.0.1:8000')
+    parser.add_argument('-s', '--spine', metavar='file-list', type=Path,
+                        help='post this file list; its paths are resolved on the server under `--dir`')
+    parser.add_argument('--dir', metavar='dir', default='.',
+                        help='the dir of the file list, relative to the root of the server')
+    parser.add_argument('--zip', metavar='dir', type=Path,
+                        help='post the files under this dir as a zip of the sources')
+    parser.add_argument('--name', metavar='package-name', default='loadgen')
+    parser.add_argument('-n', '--requests', metavar='N', type=int, default=100)
+    parser.add_argument('-c', '--concurrency', metavar='N', type=int, default=4)
+    args = parser.parse_args(argv)
+
+    params = {'name': args.name}
+    if args.zip:
+        body, content_type = zip_sources(args.zip), 'application/zip'
+    elif args.spine:
+        body, content_type = args.spine.read_bytes(), 'text/tab-separated-values'
+        params['dir'] = args.dir
+    else:
+        parser.error('either `--spine` or `--zip` is needed')
+    print(run(args.url, body, content_type, args.requests, args.concurrency, params))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
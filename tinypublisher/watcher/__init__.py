@@ -0,0 +1,97 @@
+from pathlib import Path
+from typing import Callable, Optional
+import os, time
+
+import tinypublisher as app
+from tinypublisher.package import PackageSpec
+from tinypublisher.reader import FileListParser, InspectionLimits
+from tinypublisher.builder import PackageBuilder
+from tinypublisher.progress import Progress
+import tinypublisher.archive as archive
+
+import logging
+logger = logging.getLogger(f'{app.__appname__}.watcher')
+
+
+_Stat = tuple[int, int]
+
+class Watcher:
+    """Keeps the parser and the builder alive and rebuilds the package when
+    the file list or any of its resources is modified. Changes are detected by
+    polling `os.stat`, and only the modified files are inspected again and
+    only the affected items are packaged again. The local files linked but
+    missing are watched too. The package is zipped as `PackageBuilder.zipup`
+    with the `jobs` and the `cache_size`."""
+
+    def __init__(self, spine: Path, pkgname: str,
+                 configure: Optional[Callable[[PackageSpec], None]] = None,
+                 zipped: bool = True, interval: float = 0.25,
+                 limits: Optional[InspectionLimits] = None, jobs: int = 1,
+                 cache_size: int = archive.MEMBER_CACHE_SIZE,
+                 progress: Optional[Progress] = None) -> None:
+        self.spine = spine
+        self.configure = configure
+        self.zipped = zipped
+        self.interval = interval
+        self.jobs = jobs
+        self.cache_size = cache_size
+        self.parser = FileListParser(spine.parent, limits)
+        self.builder = PackageBuilder(pkgname, progress)
+        self.stats: dict[str, Optional[_Stat]] = {}
+
+    def build(self) -> PackageSpec:
+        with open(self.spine) as f:
+            spec = self.parser.parse(f)
+        if self.configure:
+            self.configure(spec)
+
+        self.builder.build_with(spec)
+        if self.zipped:
+            self.builder.zipup(self.jobs, self.cache_size)
+        self.spec = spec
+        paths = dict.fromkeys([str(self.spine), *spec.input_paths(), *self.parser.input_paths(spec)])
+        self.stats = {path: _stat(path) for path in paths}
+        return spec
+
+    def modified(self) -> list[str]:
+        return [path for path, st in self.stats.items() if _stat(path) != st]
+
+    def poll(self) -> bool:
+        """Rebuilds the package if some inputs are modified."""
+        modified = self.modified()
+        if not modified:
+            return False
+
+        logger.info('rebuilding for the modified files\n' +
+                    '\n'.join(f'  -- {path}' for path in modified))
+        # if this build fails, wait for the next modification
+        for path in modified:
+            self.stats[path] = _stat(path)
+        start = time.perf_counter()
+        self.build()
+        logger.info(f'rebuilt in {time.perf_counter() - start:.3f}s')
+        return True
+
+    def run(self) -> None:
+        """Builds the package and watches the inputs until interrupted."""
+        self.build()
+        logger.info(f'watching "{self.spine}" (Ctrl-C to stop)')
+        try:
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.poll()
+                except app.AppBaseError as e:
+                    logger.error(getattr(e, 'message', str(e)))
+                except Exception as e:
+                    logger.error(f'{type(e).__name__}: {e}')
+        except KeyboardInterrupt:
+            pass
+
+
+def _stat(path: str) -> Optional[_Stat]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)